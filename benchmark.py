@@ -0,0 +1,328 @@
+"""
+Benchmarks for the hot paths of forestutils, on synthetic forests.
+
+:py:func:`synthetic_forest` writes a deterministic ``.ply`` file of a forest
+of a given number of points and tree density - gently rolling ground under
+dome-shaped crowns of varying height - so benchmarks can be run at any size
+without sharing large files.
+
+:py:func:`run` times each benchmark in a fresh Python process, so the peak
+resident memory of each is measured on its own, and appends the results to
+a JSON lines file.  Peak memory is reset after each benchmark's setup
+where the OS allows (Linux), so it covers only the timed operation;
+elsewhere it includes the setup too, which is reported as ``setup_rss``.
+:py:func:`compare` shows the change in throughput
+between the last two runs of each benchmark.  From a script::
+
+    from forest3D import benchmark
+    benchmark.main()  # eg. --points 1e6 1e7 --benchmarks read update_spatial
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from . import forestutils, geoply, gridstore, pointcloudfile, telemetry
+
+
+# UTM origin written to the offset file of each synthetic forest
+SYNTHETIC_ORIGIN = (500000.0, 6100000.0, 0.0)
+
+
+def _terrain(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Height of the synthetic ground surface at x, y."""
+    return 2 * np.sin(x / 37) + 1.5 * np.cos(y / 23) + 0.01 * x
+
+
+def synthetic_forest(fname: str, points: int, trees_per_ha: float=200,
+                     seed: int=0, points_per_m2: float=100,
+                     ground_fraction: float=0.4,
+                     chunk_points: int=2**20) -> None:
+    """
+    Write a synthetic forest of the given number of points to fname.
+
+    The site is square, sized for points_per_m2, with trees placed
+    uniformly at random.  A fraction of points are on the ground; the rest
+    are on tree crowns, each tree taking points in proportion to its crown
+    area.  The output depends only on the arguments, and a Pix4D-style
+    offset file is written alongside so the cloud is georeferenced.
+    """
+    rng = np.random.default_rng(seed)
+    side = math.sqrt(points / points_per_m2)
+    n_trees = max(1, int(round(trees_per_ha * side**2 / 10**4)))
+    tree_x = rng.uniform(0, side, n_trees)
+    tree_y = rng.uniform(0, side, n_trees)
+    height = rng.uniform(5, 30, n_trees)
+    radius = 1 + 0.15 * height
+    weight = radius**2 / (radius**2).sum()
+
+    header = pointcloudfile.PlyHeader(
+        points, ('x', 'y', 'z', 'red', 'green', 'blue'), '<fffBBB', ())
+    dtype = pointcloudfile.vertex_dtype(header)
+    with pointcloudfile.IncrementalWriter(fname, header) as writer:
+        for start in range(0, points, chunk_points):
+            size = min(chunk_points, points - start)
+            chunk = np.empty(size, dtype=dtype)
+            ground = rng.random(size) < ground_fraction
+            n_ground = int(ground.sum())
+            gx = rng.uniform(0, side, n_ground)
+            gy = rng.uniform(0, side, n_ground)
+            tree = rng.choice(n_trees, size - n_ground, p=weight)
+            r = radius[tree] * np.sqrt(rng.random(tree.size))
+            theta = rng.uniform(0, 2 * np.pi, tree.size)
+            cx = tree_x[tree] + r * np.cos(theta)
+            cy = tree_y[tree] + r * np.sin(theta)
+            cz = (_terrain(tree_x[tree], tree_y[tree]) + height[tree] *
+                  (1 - 0.5 * (r / radius[tree])**2))
+            for name, g, c in [('x', gx, cx), ('y', gy, cy),
+                               ('z', _terrain(gx, gy), cz)]:
+                chunk[name][ground] = g
+                chunk[name][~ground] = c
+            chunk['z'] += rng.normal(0, 0.02, size)
+            for name, g, c in [('red', 120, 60), ('green', 90, 140),
+                               ('blue', 60, 50)]:
+                base = np.where(ground, g, c)
+                chunk[name] = np.clip(base + rng.normal(0, 15, size), 0, 255)
+            writer.write_many(chunk)
+    with open(fname[:-4] + '_ply_offset.xyz', 'w') as f:
+        f.write('{} {} {}\n'.format(*SYNTHETIC_ORIGIN))
+
+
+def forest_file(directory: str, points: int, trees_per_ha: float=200,
+                seed: int=0) -> str:
+    """Return the name of a synthetic forest in directory, writing it first
+    if it does not exist yet."""
+    fname = os.path.join(directory, 'forest_{}_{}_{}.ply'.format(
+        points, trees_per_ha, seed))
+    if not os.path.isfile(fname):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        synthetic_forest(fname, points, trees_per_ha, seed)
+    return fname
+
+
+def _set_args(fname: str, out: str, *extra: str) -> None:
+    """Set forestutils.args as if run from the command line."""
+    argv, sys.argv = sys.argv, ['forestutils', fname, out] + list(extra)
+    try:
+        forestutils.args = forestutils.get_args()
+    finally:
+        sys.argv = argv
+
+
+def _raw_ground(fname: str) -> gridstore.Channel:
+    """Return the unsmoothed ground channel of the cloud."""
+    ground = gridstore.Channel(np.float64)
+    for chunk in pointcloudfile.read_chunks(fname):
+        x, y, _, low, _ = forestutils.cell_summary(
+            *forestutils.cell_indices(chunk), chunk['z'])
+        ground.minimum_many(x, y, low)
+    return ground
+
+
+# Each benchmark is a function of (input file, scratch directory) which
+# does any setup and returns a function to time.
+def _bench_read(fname, _):
+    return lambda: sum(1 for _ in pointcloudfile.read(fname))
+
+
+def _bench_read_chunks(fname, _):
+    return lambda: sum(c.size for c in pointcloudfile.read_chunks(fname))
+
+
+def _bench_write(fname, scratch):
+    header = pointcloudfile.parse_ply_header(
+        pointcloudfile.ply_header_text(fname))
+
+    def func():
+        with pointcloudfile.IncrementalWriter(
+                os.path.join(scratch, 'out.ply'), header) as writer:
+            for chunk in pointcloudfile.read_chunks(fname):
+                writer.write_many(chunk)
+    return func
+
+
+def _bench_update_spatial(fname, _):
+    return lambda: forestutils.MapObj(fname, colours=False)
+
+
+def _bench_smooth_ground(fname, _):
+    ground = _raw_ground(fname)
+    return lambda: forestutils.smooth_ground(ground)
+
+
+def _bench_connected_components(fname, _):
+    attr_map = forestutils.MapObj(fname, colours=False)
+    return attr_map._tree_components  # pylint:disable=protected-access
+
+
+def _bench_save_individual_trees(fname, scratch):
+    forestutils.args.savetrees = os.path.join(scratch, 'trees')
+    attr_map = forestutils.MapObj(fname, colours=False)
+    return attr_map.save_individual_trees
+
+
+def _bench_geoply_read(fname, _):
+    return lambda: geoply.GeoPly.read(fname)
+
+
+def _bench_from_geoplys(fname, _):
+    first, second = geoply.GeoPly.read(fname), geoply.GeoPly.read(fname)
+    return lambda: geoply.GeoPly.from_geoplys(first, second)
+
+
+def _bench_main_processing(fname, scratch):
+    _set_args(fname, scratch, '--savetrees', os.path.join(scratch, 'trees'))
+    return forestutils.main_processing
+
+
+# How many times each benchmark processes the input, where not once
+INPUTS = {
+    'from_geoplys': 2,
+}  # type: Dict[str, int]
+
+BENCHMARKS = {
+    'read': _bench_read,
+    'read_chunks': _bench_read_chunks,
+    'write': _bench_write,
+    'update_spatial': _bench_update_spatial,
+    'smooth_ground': _bench_smooth_ground,
+    'connected_components': _bench_connected_components,
+    'save_individual_trees': _bench_save_individual_trees,
+    'geoply_read': _bench_geoply_read,
+    'from_geoplys': _bench_from_geoplys,
+    'main_processing': _bench_main_processing,
+}  # type: Dict[str, Callable]
+
+
+def run_one(name: str, fname: str) -> Dict[str, float]:
+    """Run a single benchmark in this process, and return the seconds taken,
+    the peak memory use of the setup, and that of the timed operation -
+    or of the whole process, if the peak cannot be reset."""
+    scratch = tempfile.mkdtemp(prefix='forest3d-bench-')
+    try:
+        _set_args(fname, scratch)
+        func = BENCHMARKS[name](fname, scratch)
+        setup_rss = telemetry.peak_rss()
+        telemetry.reset_peak_rss()
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {'seconds': seconds, 'setup_rss': setup_rss,
+            'peak_rss': telemetry.peak_rss()}
+
+
+def _git_revision() -> str:
+    """The current commit of the source tree, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(names: List[str], sizes: List[int], directory: str,
+        results: str, trees_per_ha: float=200) -> List[dict]:
+    """
+    Run each benchmark on a synthetic forest of each size, in a separate
+    process, and append the results to the JSON lines file results.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [package] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    records = []
+    for points in sizes:
+        fname = forest_file(directory, points, trees_per_ha)
+        for name in names:
+            # __name__ is '__main__' when run with -m, so use the spec
+            output = subprocess.check_output(
+                [sys.executable, '-m', __spec__.name, '--child', name, fname],
+                env=env, cwd=directory)
+            record = json.loads(output.decode().splitlines()[-1])
+            record.update({
+                'benchmark': name,
+                'points': points,
+                'points_processed': points * INPUTS.get(name, 1),
+                'trees_per_ha': trees_per_ha,
+                'points_per_second':
+                    points * INPUTS.get(name, 1) / record['seconds'],
+                'date': datetime.datetime.now().isoformat(),
+                'revision': _git_revision(),
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+            })
+            print('{benchmark:>22} {points:>11,} points {seconds:9.2f}s '
+                  '{points_per_second:13,.0f} points/s '
+                  '{peak_rss:>15,} bytes peak'.format(**record))
+            records.append(record)
+            with open(results, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+    return records
+
+
+def compare(results: str) -> List[Tuple[str, int, float, float]]:
+    """
+    Print and return (benchmark, points, previous, latest) points per
+    second for each benchmark and size run at least twice.
+    """
+    runs = {}  # type: Dict[Tuple[str, int], List[float]]
+    with open(results) as f:
+        for line in f:
+            record = json.loads(line)
+            runs.setdefault((record['benchmark'], record['points']),
+                            []).append(record['points_per_second'])
+    out = []
+    for (name, points), speeds in sorted(runs.items()):
+        if len(speeds) >= 2:
+            out.append((name, points, speeds[-2], speeds[-1]))
+            print('{:>22} {:>11,} points {:13,.0f} -> {:13,.0f} points/s '
+                  '({:+.1%})'.format(name, points, speeds[-2], speeds[-1],
+                                     speeds[-1] / speeds[-2] - 1))
+    return out
+
+
+def main() -> None:
+    """Command-line interface to run or compare benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--points', nargs='+', type=float, default=[10**6],
+        help='sizes of synthetic forest to benchmark, in points')
+    parser.add_argument(
+        '--treedensity', type=float, default=200,
+        help='trees per hectare in synthetic forests')
+    parser.add_argument(
+        '--benchmarks', nargs='+', default=list(BENCHMARKS),
+        choices=list(BENCHMARKS), help='benchmarks to run (default all)')
+    parser.add_argument(
+        '--dir', default='benchmarks',
+        help='directory for synthetic forests and results')
+    parser.add_argument(
+        '--compare', action='store_true',
+        help='compare the last two runs of each benchmark, without running')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    if opts.child:
+        print(json.dumps(run_one(*opts.child)))
+        return
+    results = os.path.join(opts.dir, 'results.jsonl')
+    if not opts.compare:
+        run(opts.benchmarks, [int(p) for p in opts.points], opts.dir,
+            results, opts.treedensity)
+    compare(results)
+
+
+if __name__ == '__main__':
+    main()
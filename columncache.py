@@ -0,0 +1,164 @@
+"""
+An opt-in on-disk cache of decoded point clouds, one column at a time.
+
+The first full read of a cloud stores each vertex property as a ``.npy``
+file in a directory of its own, and records it in a JSON manifest along with
+the path, size and modification time of each source file.  Later reads of
+an unchanged cloud memory-map the columns instead of parsing the ``.ply``
+again.  When the cache grows beyond its size limit, the least recently used
+clouds are removed.
+
+:py:mod:`pointcloudfile` uses the cache when it is enabled with
+:py:func:`pointcloudfile.enable_cache`; there is no need to use this module
+directly.
+"""
+# pylint:disable=unsubscriptable-object
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+Fingerprint = Tuple[int, int]
+
+
+class ColumnCache:
+    """
+    A directory of cached clouds, with a manifest and a size limit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int=2**34) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(sources: List[str]) -> str:
+        """Return the cache key for a cloud read from the given files."""
+        paths = '\n'.join(os.path.abspath(s) for s in sources)
+        return hashlib.sha1(paths.encode('utf-8')).hexdigest()
+
+    def _load_manifest(self) -> Dict[str, dict]:
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: Dict[str, dict]) -> None:
+        """Replace the manifest atomically, so readers never see part of
+        it."""
+        temp = self.manifest_file + '.{}.tmp'.format(os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp, self.manifest_file)
+
+    def lookup(self, sources: List[str], fingerprints: List[Fingerprint]
+               ) -> Optional[Dict[str, np.ndarray]]:
+        """Return a dict of read-only memmapped columns for the cloud, in
+        field order, or None if it is not cached or the sources have
+        changed since it was."""
+        key = self.key(sources)
+        manifest = self._load_manifest()
+        entry = manifest.get(key)
+        if entry is None:
+            return None
+        if [tuple(f) for f in entry['fingerprints']] != list(fingerprints):
+            logging.info('Cached columns of "{}" are stale'.format(sources[0]))
+            self._remove(manifest, key)
+            self._save_manifest(manifest)
+            return None
+        try:
+            columns = {name: np.load(self._column_file(key, name),
+                                     mmap_mode='r')
+                       for name in entry['names']}
+        except (OSError, ValueError):
+            return None
+        entry['last_used'] = time.time()
+        self._save_manifest(manifest)
+        return columns
+
+    def _column_file(self, key: str, name: str) -> str:
+        return os.path.join(self.directory, key, name + '.npy')
+
+    def store(self, sources: List[str], fingerprints: List[Fingerprint],
+              chunks: Iterator[np.ndarray], count: int
+              ) -> Iterator[np.ndarray]:
+        """Yield the chunks of a cloud of count points, storing each column
+        as it goes.  The cloud is added to the manifest only if every chunk
+        is consumed, and the least recently used clouds are then evicted to
+        keep the cache under its size limit."""
+        key = self.key(sources)
+        temp = os.path.join(self.directory, key + '.{}.tmp'.format(os.getpid()))
+        columns = {}  # type: Dict[str, np.ndarray]
+        names = []  # type: List[str]
+        position = 0
+        try:
+            for chunk in chunks:
+                if not columns:
+                    os.makedirs(temp, exist_ok=True)
+                    names = list(chunk.dtype.names)
+                    columns = {n: np.lib.format.open_memmap(
+                        os.path.join(temp, n + '.npy'), mode='w+',
+                        dtype=chunk.dtype[n], shape=(count,)) for n in names}
+                for name in names:
+                    columns[name][position:position + chunk.size] = chunk[name]
+                position += chunk.size
+                yield chunk
+            if position != count:
+                return
+            for column in columns.values():
+                column.flush()
+            columns.clear()
+            manifest = self._load_manifest()
+            self._remove(manifest, key)
+            if names:
+                os.replace(temp, os.path.join(self.directory, key))
+            manifest[key] = {
+                'sources': [os.path.abspath(s) for s in sources],
+                'fingerprints': [list(f) for f in fingerprints],
+                'names': names,
+                'count': count,
+                'bytes': self._size(key) if names else 0,
+                'last_used': time.time(),
+            }
+            self._evict(manifest, keep=key)
+            self._save_manifest(manifest)
+        finally:
+            columns.clear()
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def _size(self, key: str) -> int:
+        folder = os.path.join(self.directory, key)
+        return sum(os.path.getsize(os.path.join(folder, f))
+                   for f in os.listdir(folder))
+
+    def _remove(self, manifest: Dict[str, dict], key: str) -> None:
+        """Remove a cloud from the manifest and delete its columns."""
+        manifest.pop(key, None)
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def _evict(self, manifest: Dict[str, dict], keep: str=None) -> None:
+        """Remove least recently used clouds until the cache fits its size
+        limit, never removing keep."""
+        total = sum(e['bytes'] for e in manifest.values())
+        for key in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                logging.info('Evicting cached columns of "{}"'.format(
+                    manifest[key]['sources'][0]))
+                total -= manifest[key]['bytes']
+                self._remove(manifest, key)
+
+    def report(self) -> Dict[str, int]:
+        """Return a dict of the bytes cached for each source file."""
+        return {e['sources'][0]: e['bytes']
+                for e in self._load_manifest().values()}
@@ -29,22 +29,34 @@ and `pointclouds <http://phenocam.org.au/pointclouds>`_.
 LOG_NAME = 'forestutils'
 
 import argparse
+import contextlib
 import csv
 import math
+import multiprocessing
 import os
 import datetime
 import logging
 from typing import MutableMapping, NamedTuple, Tuple, Set
 
+import numpy as np
 import utm  # type: ignore
 
-from . import pointcloudfile
+from . import gridstore, pointcloudfile, telemetry
 
 
 # User-defined types
-#XY_Coord is
-XY_Coord = NamedTuple('XY_Coord', [('x', int), ('y', int)])
+XY_Coord = gridstore.XY_Coord
 Coord_Labels = MutableMapping[XY_Coord, int]
+# The cell and classes of each point in a chunk, from MapObj.classify
+Point_Classes = NamedTuple('Point_Classes', [
+    ('x', np.ndarray), ('y', np.ndarray), ('ground', np.ndarray),
+    ('lowest', np.ndarray), ('tree', np.ndarray)])
+
+# Maximum number of passes of the ground smoothing algorithm
+SMOOTHING_PASSES = 100
+
+# Timings and counters for the current run; replaced by main()
+run_stats = telemetry.Telemetry()
 
 
 def coords(pos):
@@ -60,6 +72,36 @@ def coords(pos):
     return XY_Coord(x, y)
 
 
+def cell_indices(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorised version of coords() for a structured array of points.
+    Returns arrays of the integer x and y cell index of each point.
+    """
+    x = np.floor(points['x'].astype(np.float64) / args.cellsize)
+    y = np.floor(points['y'].astype(np.float64) / args.cellsize)
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def cell_summary(cell_x: np.ndarray, cell_y: np.ndarray, z: np.ndarray):
+    """
+    Reduce per-point cell indices and heights to per-cell statistics.
+    Returns arrays of (x, y, count, min z, max z) for each distinct cell,
+    sorted by x then y, using a sort and grouped reductions instead of a
+    Python loop over points.
+    """
+    if not cell_x.size:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, z[:0], z[:0]
+    order = np.lexsort((cell_y, cell_x))
+    sx, sy, sz = cell_x[order], cell_y[order], z[order]
+    starts = np.flatnonzero(np.concatenate(
+        ([True], (sx[1:] != sx[:-1]) | (sy[1:] != sy[:-1]))))
+    counts = np.diff(np.append(starts, sx.size))
+    z_min = np.minimum.reduceat(sz, starts)
+    z_max = np.maximum.reduceat(sz, starts)
+    return sx[starts], sy[starts], counts, z_min, z_max
+
+
 def neighbors(key: XY_Coord) -> Tuple[XY_Coord, ...]:
     """
     Take an XY coordinate key and return the adjacent keys,
@@ -69,90 +111,171 @@ def neighbors(key: XY_Coord) -> Tuple[XY_Coord, ...]:
                  for a in (-1, 0, 1) for b in (-1, 0, 1) if a or b)
 
 
-def connected_components(input_dict: Coord_Labels) -> None:
+def label_components(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     """
-    Connected components in a dict of coordinates.
-    Uses depth-first search.  Non-component cells are absent from the input.
+    Label the eight-connected components of a set of distinct cells.
+
+    Uses an iterative union-find over the edges between neighbouring cells,
+    with union by size and path halving, so labelling takes near-linear time
+    in the number of cells (amortised inverse Ackermann per edge) and there
+    is no recursion.
+
+    Returns consecutive integer labels from zero, numbered in order of the
+    lowest (x, y) cell in each component.
     """
-    def expand(old_key: XY_Coord, com: MutableMapping) -> None:
-        """
-        Implement depth-first search.
-		"""
-        for key in neighbors(old_key):
-            if com.get(key) is None:
-                return
-            if com[key] == com[old_key]:
-                continue
-            elif com[key] < com[old_key]:
-                com[old_key] = com[key]
-            else:
-                com[key] = com[old_key]
-                expand(key, com)
+    if not x.size:
+        return np.empty(0, dtype=np.int64)
+    # Encode each cell as a single sortable integer to find neighbours
+    order = np.lexsort((y, x))
+    height = int(y.max() - y.min()) + 3
+    keys = (x[order] - x.min() + 1) * height + (y[order] - y.min() + 1)
+    # Edges to the neighbours "after" each cell cover every adjacent pair
+    starts, ends = [], []
+    for dx, dy in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        target = keys + dx * height + dy
+        pos = np.minimum(np.searchsorted(keys, target), keys.size - 1)
+        found = keys[pos] == target
+        starts.append(np.flatnonzero(found))
+        ends.append(pos[found])
+    roots = _union_roots(keys.size, np.concatenate(starts),
+                         np.concatenate(ends))
+    # Each root is the lowest sorted cell in its component
+    labels = np.empty(keys.size, dtype=np.int64)
+    labels[order] = np.unique(roots, return_inverse=True)[1].reshape(-1)
+    return labels
 
-    for key in tuple(input_dict):
-        try:
-            expand(key, input_dict)
-        except RuntimeError:
-            logging.info('Maximum recursion depth exceeded; finishing run.')
-            # Recursion depth; finish on next pass.
+
+def _union_roots(size: int, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """
+    Union-find for nodes 0 to size-1, joined by edges from start to end.
+    Returns the root of each node, which is the lowest node in its set.
+    """
+    parent = list(range(size))
+    weight = [1] * size
+    for a, b in zip(start.tolist(), end.tolist()):
+        # Find both roots, halving the paths on the way
+        while parent[a] != a:
+            parent[a] = a = parent[parent[a]]
+        while parent[b] != b:
+            parent[b] = b = parent[parent[b]]
+        if a == b:
             continue
+        # Hang the smaller set from the root of the larger
+        if weight[a] < weight[b]:
+            a, b = b, a
+        parent[b] = a
+        weight[a] += weight[b]
+    # Union by size keeps every tree at most log2(size) deep, so pointer
+    # jumping takes a few rounds to point every node at its root
+    root = np.array(parent, dtype=np.int64)
+    grandparent = root[root]
+    while (grandparent != root).any():
+        root = grandparent
+        grandparent = root[root]
+    # Name each set by its lowest node
+    lowest = np.full(size, size, dtype=np.int64)
+    np.minimum.at(lowest, root, np.arange(size))
+    return lowest[root]
+
+
+def _neighbours(window: np.ndarray) -> np.ndarray:
+    """
+    Take a 2D window with a one-cell halo, and return an array of shape
+    (8, width - 2, height - 2) of the neighbours of each interior cell.
+    """
+    w, h = window.shape
+    return np.stack([window[1 + a:w - 1 + a, 1 + b:h - 1 + b]
+                     for a in (-1, 0, 1) for b in (-1, 0, 1) if a or b])
 
 
-def detect_issues(ground_dict: Coord_Labels, prior: set) -> Set[XY_Coord]:
+def detect_issues(values: np.ndarray, present: np.ndarray,
+                  prior: np.ndarray) -> np.ndarray:
     """
     Identifies cells with more than 2:1 slope to 3+ adjacent cells.
     Greater than 2:1 slope is suspiciously steep; 3+ usually indicates a
     misclassified cell or data artefact.
+
+    values and present are a window of the ground map with a one-cell halo
+    around the prior array of cells to check.  As for a set of heights,
+    each distinct neighbouring height is only counted once.
     """
-    problematic = set()
-    for k in prior:
-        adjacent = {ground_dict.get(n) for n in neighbors(k)}
-        adjacent.discard(None)
-        if len(adjacent) < 6:
-            continue
-        # Number of cells at more than 2:1 slope - suspiciously steep.
-        # 3+ usually indicates a misclassified cell or data artefact.
-        probs = sum(abs(ground_dict[k]-n) > 2*args.cellsize for n in adjacent)
-        if probs >= 3:
-            problematic.add(k)
-    return problematic
+    adjacent = np.where(_neighbours(present), _neighbours(values), np.nan)
+    adjacent.sort(axis=0)  # Missing cells (NaN) sort last
+    distinct = ~np.isnan(adjacent)
+    distinct[1:] &= adjacent[1:] != adjacent[:-1]
+    # Number of cells at more than 2:1 slope - suspiciously steep.
+    steep = np.abs(values[1:-1, 1:-1] - adjacent) > 2*args.cellsize
+    probs = (distinct & steep).sum(axis=0)
+    return prior & (distinct.sum(axis=0) >= 6) & (probs >= 3)
 
 
-def smooth_ground(ground_dict: Coord_Labels) -> None:
+def smooth_ground(ground: gridstore.Channel) -> None:
     """
     Smoothes the ground map, to reduce the impact of spurious points, eg.
     points far underground or misclassification of canopy as ground.
+
+    Works a tile at a time on dense windows of the map.  Each pass lowers
+    problematic cells to just above their lowest unproblematic neighbour,
+    and only cells found in the previous pass are checked again.  Stops early
+    once a pass changes nothing, as every later pass would be identical.
     """
     logging.info('Smoothing the ground map.')
-    problematic = set(ground_dict)
-    for _ in range(100):
-        problematic = detect_issues(ground_dict, problematic)
-        for key in problematic:
-            adjacent = {ground_dict.get(n) for n in neighbors(key)
-                        if n not in problematic}
-            adjacent.discard(None)
-            if not adjacent:
-                continue
-            ground_dict[key] = min(adjacent) + 2*args.cellsize
+    size = ground.tile_size
+    prior = {key: ground.window(key[0]*size, key[1]*size, size, size)[1]
+             for key in ground.tile_keys()}
+    for _ in range(SMOOTHING_PASSES):
+        problematic = gridstore.Channel(bool, size)
+        for key, cells in prior.items():
+            x0, y0 = key[0]*size, key[1]*size
+            found = detect_issues(
+                *ground.window(x0 - 1, y0 - 1, size + 2, size + 2), cells)
+            problematic.write_window(x0, y0, found, found)
+        if not problematic:
+            return
+        changed = False
+        prior = {}
+        for key in problematic.tile_keys():
+            x0, y0 = key[0]*size, key[1]*size
+            values, present = ground.window(x0 - 1, y0 - 1, size + 2, size + 2)
+            problem = problematic.window(x0 - 1, y0 - 1, size + 2, size + 2)[1]
+            adjacent = np.where(_neighbours(present & ~problem),
+                                _neighbours(values), np.inf)
+            lowest = adjacent.min(axis=0) + 2*args.cellsize
+            prior[key] = problem[1:-1, 1:-1]
+            update = prior[key] & np.isfinite(lowest)
+            changed |= bool((values[1:-1, 1:-1] != lowest)[update].any())
+            ground.write_window(x0, y0, lowest, update)
+        if not changed:
+            return
 
 
 class MapObj:
     """
     Stores a maximum and minimum height map of the cloud, in GRID_SIZE
     cells.  Hides data structure and accessed through coordinates.
-    Data structure is a set of dictionaries, one for each attribute. Each dict
-    is a contains, for a single attribute, all the values for all the points.
-    Note that the dict is faster to access than an array.
+    Data structure is a tiled grid with one typed channel for each attribute.
+    Each channel acts like a dict of cells to values for that attribute, but
+    stores them in compact Numpy tiles and supports vectorised access.
     """
     # pylint:disable=too-many-instance-attributes
 
-    def __init__(self, input_file, *, colours=True):
+    def __init__(self, input_file, *, colours=True, bounds=None, processes=1,
+                 state=None, label=True):
         """
         Args:
             input_file (path): the ``.ply`` file to process.  If dealing with
                 Pix4D outputs, ``*_part_1.ply``.
             colours (bool): whether to read colours from the file.  Set to
                 False for eg. LIDAR data where mean colour is not useful.
+            bounds (tuple): if given, only map points in cells from (x0, y0)
+                up to but excluding (x1, y1).  Used to map a single tile.
+            processes (int): if more than one, map the site in tiles using
+                this many worker processes; see update_spatial_tiled.
+            state (path): a grid state file from save_state.  If it matches
+                the input file and settings, the grid is loaded from it and
+                only trees are labelled again.
+            label (bool): whether to label trees after mapping.  Set to
+                False if the caller labels trees itself, eg. for a tile.
             prev_csv (path): path to a csv file which associates a name
                 with coordinates, to correctly name detected trees.
             zone (int): the UTM zone of the site.
@@ -160,46 +283,205 @@ class MapObj:
         """
         logging.debug('Create a MapObj')
         self.file = input_file
-        self.canopy = dict()
-        self.density = dict()
-        self.filtered_density = dict()
-        self.ground = dict()
-        self.colours = dict()
-        self.trees = dict()
-
         self.header = pointcloudfile.parse_ply_header(
             pointcloudfile.ply_header_text(input_file))
+
+        self.grid = gridstore.TiledGrid()
+        self.canopy = self.grid.add_channel('canopy', np.float64)
+        self.density = self.grid.add_channel('density', np.uint32)
+        self.filtered_density = self.grid.add_channel(
+            'filtered_density', np.uint32)
+        self.ground = self.grid.add_channel('ground', np.float64)
+        self.trees = self.grid.add_channel('trees', np.int32)
+        # One channel per colour (ie non-xyz) attribute, to sum values
+        dtype = pointcloudfile.vertex_dtype(self.header)
+        self.colours = {name: self.grid.add_channel(
+            'colour_' + name, np.float64 if dtype[name].kind == 'f'
+            else np.int64) for name in dtype.names if name not in 'xyz'}
         logging.info('Moving x,y by utm offset by calling pointcloudfile.offset_for({})'.format(input_file))
         x, y, _ = pointcloudfile.offset_for(input_file)
         self.utm = pointcloudfile.UTM_Coord(x, y, args.utmzone, args.north)
 
-        self.update_spatial()
+        self.bounds = bounds
+        self.state_loaded = state is not None and self.load_state(state)
+        if self.state_loaded:
+            self.trees.clear()
+            self.trees.set_many(*self._tree_components())
+            return
+        if processes > 1:
+            self.update_spatial_tiled(processes)
+        else:
+            self.update_spatial(label=label)
         if colours:
             self.update_colours()
 
-    def update_spatial(self):
+    def save_state(self, fname: str) -> None:
+        """
+        Save every channel except the tree labels to a .npz file, tagged with
+        the cellsize and grounddepth and the fingerprint of the mapped file.
+
+        Cell indices are stored once, and each channel as an array of values
+        for those cells - with a mask if it is absent from some cells.
+        """
+        x, y, _ = self.density.to_arrays()
+        arrays = {'x': x, 'y': y}
+        names = [n for n, c in self.grid.channels.items() if c is not self.trees]
+        for name in names:
+            channel = self.grid[name]
+            present = channel.contains_many(x, y)
+            arrays[name] = channel.get_many(x, y, default=0)
+            if not present.all():
+                arrays[name + '_present'] = present
+        np.savez(fname, cellsize=args.cellsize, grounddepth=args.grounddepth,
+                 fingerprint=pointcloudfile.fingerprints(self.file),
+                 channels=names, **arrays)
+        logging.info('Saved grid state to "{}"'.format(fname))
+
+    def load_state(self, fname: str) -> bool:
+        """
+        Load the channels saved by save_state, if the file exists and matches
+        the current file and settings.  Returns whether it was loaded.
+        """
+        if not os.path.isfile(fname):
+            return False
+        names = [n for n, c in self.grid.channels.items() if c is not self.trees]
+        with np.load(fname) as state:
+            if (state['cellsize'] != args.cellsize or
+                    state['grounddepth'] != args.grounddepth or
+                    state['fingerprint'].tolist() !=
+                    [list(f) for f in pointcloudfile.fingerprints(self.file)]
+                    or state['channels'].tolist() != names):
+                logging.info('Grid state "{}" is out of date'.format(fname))
+                return False
+            x, y = state['x'], state['y']
+            for name in names:
+                present = (state[name + '_present'] if name + '_present'
+                           in state else np.ones(x.size, dtype=bool))
+                self.grid[name].clear()
+                self.grid[name].set_many(
+                    x[present], y[present], state[name][present])
+        logging.info('Loaded grid state from "{}"'.format(fname))
+        return True
+
+    def update_spatial(self, label=True):
         """
         Expand, correct, or maintain map with a new observed point.
 		Initialize density and filtered_density to 1.
         Increment density but do not increment filtered_density - that is done
         in function update_colors
+        Trees are labelled afterwards, unless label is False.
         """
-        # Fill out the spatial info in the file
-        for p in pointcloudfile.read(self.file):
-            idx = coords(p)
-            if self.density.get(idx) is None:
-                self.density[idx] = 1
-                self.canopy[idx] = p.z
-                self.ground[idx] = p.z
-                self.filtered_density[idx] = 1
-                continue
-            self.density[idx] += 1
-            if self.ground[idx] > p.z:
-                self.ground[idx] = p.z
-            elif self.canopy[idx] < p.z:
-                self.canopy[idx] = p.z
+        # Fill out the spatial info in the file, a chunk of points at a time
+        bbox = None
+        if self.bounds is not None:
+            # Pad by a cell, as the bounds are exactly checked below
+            x0, y0, x1, y1 = self.bounds
+            bbox = tuple(args.cellsize * v for v in (x0 - 1, y0 - 1,
+                                                     x1 + 1, y1 + 1))
+        for chunk in self._chunks(bbox):
+            x, y = cell_indices(chunk)
+            z = chunk['z']
+            if self.bounds is not None:
+                x0, y0, x1, y1 = self.bounds
+                inside = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+                x, y, z = x[inside], y[inside], z[inside]
+            x, y, count, low, high = cell_summary(x, y, z)
+            new = ~self.density.contains_many(x, y)
+            self.filtered_density.set_many(x[new], y[new], 1)
+            self.density.add_many(x, y, count)
+            self.ground.minimum_many(x, y, low)
+            self.canopy.maximum_many(x, y, high)
+        logging.info('Grid uses {} bytes for {} cells'.format(
+            self.grid.nbytes, len(self.density)))
         smooth_ground(self.ground)
-        self.trees = self._tree_components()
+        self.trees.clear()
+        if label:
+            self.trees.set_many(*self._tree_components())
+
+    def update_spatial_tiled(self, processes: int) -> None:
+        """
+        Build the same map as update_spatial, by splitting the site into
+        square tiles of 'tilesize' metres and mapping each in a process pool.
+
+        Each worker maps its tile plus a halo wide enough that smoothing
+        the ground is exact for the tile and a band around it, and labels
+        trees in the tile and band.  Labels which share a cell where the
+        bands of neighbouring tiles overlap are then joined, so that a crown
+        spanning several tiles gets one ID, and renumbered in the same order
+        as _tree_components would for the whole site.
+
+        The sidecar index of the input is built first if need be, and gives
+        the extent of the site - or if it cannot be written, eg. in a
+        read-only directory, the extent is found by reading the input.  Workers use it to read only their region,
+        which is cheap if the input is spatially ordered (eg. a sparse cloud
+        written with the 'zorder' flag); otherwise each worker reads most of
+        the file, so I/O grows with the number of tiles.
+
+        The halo is over 200 cells wide whatever the tile size, and the
+        ground of each tile and halo is smoothed in full, so tiles should be
+        many times wider than the halo.  Smaller tiles repeat most of the
+        work, and are slower than mapping in one process.
+        """
+        # Smoothing changes cells up to two cells away per pass, so the
+        # band is exact if the halo is wider than the band by that much
+        band = int(math.ceil(2 * args.joinedcells)) + 4
+        halo = 2 * SMOOTHING_PASSES + 1 + band
+        size = max(1, int(round(args.tilesize / args.cellsize)))
+        if size < 2 * halo:
+            logging.warning(
+                'Tiles of {} cells are less than twice as wide as the halo '
+                'of {} cells, so most work is repeated in each halo; use a '
+                'tilesize of at least {} metres'.format(
+                    size, halo, 2 * halo * args.cellsize))
+        try:
+            pointcloudfile.update_index(self.file)
+            bbox = pointcloudfile.index_bbox(self.file)
+        except OSError as err:
+            logging.warning(
+                'Could not write an index of "{}" ({}), so every tile will '
+                'read the whole file'.format(self.file, err))
+            bbox = pointcloudfile.scan_bbox(self.file)
+        x_min, y_min, x_max, y_max = (
+            int(math.floor(v / args.cellsize)) for v in bbox)
+        jobs = [(self.file, (x0, y0, x0 + size, y0 + size), halo, band)
+                for x0 in range(x_min, x_max + 1, size)
+                for y0 in range(y_min, y_max + 1, size)]
+        logging.info('Mapping {} tiles with {} processes'.format(
+            len(jobs), processes))
+        with multiprocessing.Pool(processes, _init_worker, (args,)) as pool:
+            results = pool.map(_map_tile, jobs)
+
+        # Paste the cells of each tile into the map, and give every label
+        # from every tile a distinct node number
+        labelled, nodes = [], 0
+        for (x, y, density, ground, canopy), (lx, ly, labels) in results:
+            self.density.set_many(x, y, density)
+            self.filtered_density.set_many(x, y, 1)
+            self.ground.set_many(x, y, ground)
+            self.canopy.set_many(x, y, canopy)
+            labelled.append((lx, ly, labels + nodes))
+            nodes += int(labels.max()) + 1 if labels.size else 0
+        logging.info('Grid uses {} bytes for {} cells'.format(
+            self.grid.nbytes, len(self.density)))
+        self.trees.clear()
+        if not nodes:
+            return
+        x, y, node = (np.concatenate(a) for a in zip(*labelled))
+        # Join the nodes of cells labelled by more than one tile
+        order = np.lexsort((y, x))
+        x, y, node = x[order], y[order], node[order]
+        same = (x[1:] == x[:-1]) & (y[1:] == y[:-1])
+        roots = _union_roots(nodes, node[:-1][same], node[1:][same])
+        first = np.concatenate(([True], ~same))
+        x, y, root = x[first], y[first], roots[node[first]]
+        # Number trees in order of their lowest large cell
+        large = np.lexsort((np.floor(y / args.joinedcells),
+                            np.floor(x / args.joinedcells)))
+        unique_roots, first_seen = np.unique(root[large], return_index=True)
+        label_of = np.empty(unique_roots.size, dtype=np.int64)
+        label_of[np.argsort(first_seen)] = np.arange(unique_roots.size)
+        self.trees.set_many(
+            x, y, label_of[np.searchsorted(unique_roots, root)])
 
     def update_colours(self):
         """
@@ -207,19 +489,23 @@ class MapObj:
         """
         # We assume that vertex attributes not named "x", "y" or "z"
         # are colours, and thus accumulate a total to get the mean
-        for p in pointcloudfile.read(self.file):
-            if self.is_ground(p):
-                continue
-            p_cols = {k: v for k, v in p._asdict().items() if k not in 'xyz'}
-            idx = coords(p)
-            # filtered_density is the total number of points in the tree after
-            # the ground has been removed
-            self.filtered_density[idx] += 1
-            if idx not in self.colours:
-                self.colours[idx] = p_cols
-            else:
-                for k, v in p_cols.items():
-                    self.colours[idx][k] += v
+        rasters = self.rasters(trees=False)
+
+        def compute(chunk):
+            classes = self.classify(chunk, rasters)
+            keep = ~classes.ground
+            return classes.x[keep], classes.y[keep], chunk[keep]
+
+        pointcloudfile.pipeline(self._chunks(),
+                                compute, lambda out: self._add_colours(*out))
+
+    def _add_colours(self, x, y, points) -> None:
+        """Accumulate the colours of non-ground points into their cells."""
+        # filtered_density is the total number of points in the tree after
+        # the ground has been removed
+        self.filtered_density.add_many(x, y, 1)
+        for name, channel in self.colours.items():
+            channel.add_many(x, y, points[name])
 
     def is_ground(self, point) -> bool:
         """
@@ -234,35 +520,82 @@ class MapObj:
         """
         return point[2] == self.ground[coords(point)]
 
+    def rasters(self, trees=True) -> Tuple[gridstore.Raster,
+                                           gridstore.Raster]:
+        """
+        Return (ground, trees) rasters of the grid for classify, without
+        tree labels unless trees is true.  They share the tiles of the
+        channels; take them again after the ground or trees change.
+        """
+        return (self.ground.raster(), self.trees.raster() if trees else None)
+
+    def classify(self, chunk, rasters=None) -> Point_Classes:
+        """
+        Classify a chunk of points at once.  Returns the x and y cell of
+        each point, arrays of is_ground and is_lowest for each point, and
+        the ID of the tree of each point or -1 if none.
+
+        rasters are from self.rasters(), and are taken for each call if not
+        given - take them once to classify many chunks.  If they have no
+        tree labels, tree is None.
+        """
+        ground, trees = rasters or self.rasters()
+        x, y = cell_indices(chunk)
+        height = ground.get_many(x, y)
+        return Point_Classes(
+            x, y, chunk['z'] - height < args.grounddepth,
+            chunk['z'] == height,
+            None if trees is None else trees.get_many(x, y, default=-1))
+
+    def _chunks(self, bbox=None):
+        """Yield chunks of points from the file, counted in run_stats."""
+        return run_stats.track(
+            pointcloudfile.read_chunks(self.file, bbox=bbox))
+
     def __len__(self) -> int:
         """Total observed points.
         """
-        return sum(self.density.values())
-
-    def _tree_components(self) -> Coord_Labels:
-        """Returns a dict where keys refer to connected components.
-        NB: Not all keys in other dicts exist in this output.
-        """
-        # Set up a boolean array of larger keys to search
-        key_scale_record = {}  # type: Dict[XY_Coord, Set[XY_Coord]]
-        for key in self.density:
-            if self.canopy[key] - self.ground[key] > args.slicedepth:
-                cc_key = XY_Coord(int(math.floor(key.x / args.joinedcells)),
-                                  int(math.floor(key.y / args.joinedcells)))
-                if cc_key not in key_scale_record:
-                    key_scale_record[cc_key] = {key}
-                else:
-                    key_scale_record[cc_key].add(key)
-        # Assign a unique integer value to each large key, then search
-        # Final labels are positive ints, but not ordered or consecutive
-        trees = {k: i for i, k in enumerate(tuple(key_scale_record))}
-        connected_components(trees)
+        return self.density.sum()
+
+    def _tree_components(self, bounds=None
+                        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns (x, y, label) arrays where labels are connected components.
+        NB: Not all keys in other channels are in this output.
+        If bounds (x0, y0, x1, y1) are given, only large keys which are
+        entirely within those cells are labelled.
+        """
+        # Find cells tall enough to be canopy
+        x, y, canopy = self.canopy.to_arrays()
+        tall = canopy - self.ground.get_many(x, y) > args.slicedepth
+        x, y = x[tall], y[tall]
+        # Map each to a larger key, and label the components of larger keys
+        large_x = np.floor(x / args.joinedcells).astype(np.int64)
+        large_y = np.floor(y / args.joinedcells).astype(np.int64)
+        large, inverse = np.unique(np.stack([large_x, large_y], axis=1),
+                                   axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if bounds is not None:
+            x0, y0, x1, y1 = bounds
+            start, end = large * args.joinedcells, (large + 1) * args.joinedcells
+            # Allow a cell of margin for rounding in the division above
+            inside = ((start[:, 0] >= x0 + 1) & (end[:, 0] <= x1 - 1) &
+                      (start[:, 1] >= y0 + 1) & (end[:, 1] <= y1 - 1))
+            keep = inside[inverse]
+            x, y = x[keep], y[keep]
+            inverse = (np.cumsum(inside) - 1)[inverse[keep]]
+            large = large[inside]
+        labels = label_components(large[:, 0], large[:, 1])
         # Copy labels to grid of original scale
-        return {s: trees[k] for k, v in key_scale_record.items() for s in v}
+        return x, y, labels[inverse]
 
     def tree_data(self, keys: Set[XY_Coord]) -> dict:
         """
         Return a dictionary of data about the tree in the given keys.
+
+        Colours are the mean of the non-ground points of the whole tree.
+        (Before the grid was tiled, they were the mean of whichever cell of
+        the tree came last in a set.)  They are left out if the tree has no
+        non-ground points.
         """
         # Calculate positional information
         x = self.utm.x + args.cellsize * sum(k.x for k in keys) / len(keys)
@@ -282,8 +615,11 @@ class MapObj:
         for k in keys:
             out['height'] = max(out['height'], self.canopy[k] - self.ground[k])
             out['point_count'] += self.density[k]
-            for colour, total in self.colours[k].items():
-                out[colour] = total / self.filtered_density[k]
+        # Mean colour of the non-ground points over the whole tree
+        filtered = sum(self.filtered_density[k] for k in keys)
+        if filtered:
+            for colour, channel in self.colours.items():
+                out[colour] = sum(channel.get(k, 0) for k in keys) / filtered
         return out
 
     def all_trees(self):
@@ -303,15 +639,28 @@ class MapObj:
                 # Filter trees by height
                 yield data
 
-    def save_sparse_cloud(self, new_fname, lowest=True, canopy=True):
+    def save_sparse_cloud(self, new_fname, lowest=True, canopy=True,
+                          zorder=False):
         """
         Yield points for a canopy-only point cloud, eliminating ~3/4 of all
-        points without affecting analysis.
+        points without affecting analysis.  Reading, classifying and writing
+        run in overlapping stages - see pointcloudfile.pipeline.
+
+        If zorder is true, points are written in Morton order of their grid
+        cell, so the points of each area are stored close together.
         """
-        newpoints = (point for point in pointcloudfile.read(self.file)
-                     if canopy and not self.is_ground(point) or
-                     lowest and self.is_lowest(point))
-        pointcloudfile.write(newpoints, new_fname, self.header, self.utm)
+        rasters = self.rasters(trees=False)
+
+        def compute(chunk):
+            classes = self.classify(chunk, rasters)
+            keep = canopy & ~classes.ground | lowest & classes.lowest
+            return chunk[keep]
+
+        with pointcloudfile.IncrementalWriter(
+                new_fname, self.header, self.utm,
+                cellsize=args.cellsize if zorder else None) as sparse:
+            pointcloudfile.pipeline(self._chunks(),
+                                    compute, sparse.write_many)
         if lowest and canopy:
             self.file = new_fname
 
@@ -320,27 +669,93 @@ class MapObj:
         Save single trees to pointcloud files, if the 'savetrees' flag is set.
         Use the directory specified by the savetrees flag.
         """
-        if not args.savetrees:
+        pool = self._tree_pool()
+        if pool is None:
             return
+        rasters = self.rasters()
+        with pool:
+            pointcloudfile.pipeline(
+                self._chunks(),
+                lambda chunk: self._tree_points(
+                    chunk, self.classify(chunk, rasters).tree),
+                lambda trees: self._write_trees(pool, trees))
+
+    def _tree_pool(self):
+        """
+        Return a pointcloudfile.WriterPool for the individual tree files, or
+        None if the 'savetrees' flag is not set.
+        """
+        if not args.savetrees:
+            return None
         if os.path.isfile(args.savetrees):
             error = 'Output dir for trees is a file; a directory is required.'
             logging.error(error)
             raise IOError(error)
         if not os.path.isdir(args.savetrees):
             os.makedirs(args.savetrees)
-        # Map tree ID numbers to an incremental writer for that tree
-        tree_to_file = {tree_ID: pointcloudfile.IncrementalWriter(
-            os.path.join(args.savetrees, 'tree_{}.ply'.format(tree_ID)),
-            self.header, self.utm) for tree_ID in set(self.trees.values())}
-        # For non-ground, find the appropriate writer and call with the point
-        for point in pointcloudfile.read(self.file):
-            val = self.trees.get(coords(point))
-            if val is not None:
-                tree_to_file[val](point)
-
-    def stream_analysis(self, csv_filename: str) -> None:
+        return pointcloudfile.WriterPool(self.header, self.utm)
+
+    @staticmethod
+    def _tree_points(chunk, labels) -> list:
+        """Return a list of (tree ID, points) for the trees in a chunk,
+        given the tree label of each point from classify."""
+        order = np.argsort(labels, kind='stable')
+        labels = labels[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], labels[1:] != labels[:-1])))
+        return [(int(labels[start]), chunk[order[start:stop]]) for start, stop
+                in zip(starts, np.append(starts[1:], labels.size))
+                if labels[start] >= 0]
+
+    @staticmethod
+    def _write_trees(pool, trees: list) -> None:
+        """Write the output of _tree_points to the individual tree files."""
+        for tree_ID, points in trees:
+            pool.write(os.path.join(
+                args.savetrees, 'tree_{}.ply'.format(tree_ID)), points)
+
+    def save_all_outputs(self, new_fname, zorder=False) -> None:
+        """
+        Save the sparse cloud, accumulate colours, and save individual trees
+        (if the 'savetrees' flag is set) in a single pass over the input.
+
+        Each point is classified once, with the same results as calling
+        save_sparse_cloud, update_colours and save_individual_trees in turn
+        - which would read the input once and the sparse cloud twice.
+        Like those, reading, classifying and writing overlap in a pipeline.
+        """
+        pool = self._tree_pool()
+        rasters = self.rasters(trees=pool is not None)
+
+        def compute(chunk):
+            classes = self.classify(chunk, rasters)
+            not_ground = ~classes.ground
+            # Points kept in the sparse cloud - see save_sparse_cloud
+            keep = not_ground | classes.lowest
+            self._add_colours(classes.x[not_ground], classes.y[not_ground],
+                              chunk[not_ground])
+            trees = [] if pool is None else self._tree_points(
+                chunk[keep], classes.tree[keep])
+            return chunk[keep], trees
+
+        def write(out):
+            sparse.write_many(out[0])
+            self._write_trees(pool, out[1])
+
+        with contextlib.ExitStack() as stack:
+            if pool is not None:
+                stack.enter_context(pool)
+            sparse = stack.enter_context(pointcloudfile.IncrementalWriter(
+                new_fname, self.header, self.utm,
+                cellsize=args.cellsize if zorder else None))
+            pointcloudfile.pipeline(self._chunks(),
+                                    compute, write)
+        self.file = new_fname
+
+    def stream_analysis(self, csv_filename: str) -> list:
         """
         Save the list of trees with attributes to the file in file 'csv_filename'.
+        Returns the list of tree heights.
         """
         logging.info('Write the tree data to the csv file "{}"'.format(csv_filename))
         header = ('latitude', 'longitude', 'UTM_X', 'UTM_Y', 'UTM_zone',
@@ -349,8 +764,148 @@ class MapObj:
         with open(csv_filename, 'w', newline='') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=header)
             writer.writeheader()
+            heights = []
             for data in self.all_trees():
                 writer.writerow(data)
+                heights.append(data['height'])
+        return heights
+
+    def sweep(self, values: dict, prefix: str, processes: int=1) -> str:
+        """
+        Write the analysis for every combination of parameter values, and a
+        summary table of the tree counts and heights for each.
+
+        Args:
+            values (dict): maps 'slicedepth', 'joinedcells' and 'grounddepth'
+                to lists of values; parameters not given keep their value.
+            prefix (str): the start of the output file names.
+            processes (int): worker processes for labelling in parallel.
+
+        Returns the file name of the summary table.  The grid is mapped once;
+        each grounddepth other than the current one needs a pass over the
+        input to sum colours, but other settings only relabel the grid.
+        """
+        # pylint:disable=global-statement
+        global args, _sweep_map
+        rows = []
+        coloured = args.grounddepth
+        depths = values.get('grounddepth', [args.grounddepth])
+        for grounddepth in depths:
+            if grounddepth != coloured:
+                self._recolour(grounddepth)
+                coloured = grounddepth
+            jobs = [(grounddepth, slicedepth, joinedcells,
+                     '{}_analysis_sd{:g}_jc{:g}_gd{:g}.csv'.format(
+                         prefix, slicedepth, joinedcells, grounddepth))
+                    for slicedepth in values.get(
+                        'slicedepth', [args.slicedepth])
+                    for joinedcells in values.get(
+                        'joinedcells', [args.joinedcells])]
+            logging.info('Evaluating {} settings with grounddepth {}'.format(
+                len(jobs), grounddepth))
+            if processes > 1:
+                with multiprocessing.Pool(processes, _init_sweep_worker,
+                                          (args, self)) as pool:
+                    rows.extend(pool.map(_sweep_setting, jobs))
+            else:
+                # As _init_sweep_worker, but keeping this process's run_stats
+                saved, args = args, argparse.Namespace(**vars(args))
+                _sweep_map = self
+                try:
+                    rows.extend(_sweep_setting(job) for job in jobs)
+                finally:
+                    args = saved
+        summary = prefix + '_sweep.csv'
+        with open(summary, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return summary
+
+    def _recolour(self, grounddepth: float) -> None:
+        """Sum colours again with a different grounddepth, from the input
+        file (as the sparse cloud may lack points)."""
+        x, y, _ = self.density.to_arrays()
+        self.filtered_density.clear()
+        self.filtered_density.set_many(x, y, 1)
+        for channel in self.colours.values():
+            channel.clear()
+        args.grounddepth, previous = grounddepth, args.grounddepth
+        self.file, source = args.file, self.file
+        try:
+            self.update_colours()
+        finally:
+            args.grounddepth = previous
+            self.file = source
+
+
+def _init_worker(arguments: argparse.Namespace) -> None:
+    """Set the global args in a worker process, with its own run_stats so
+    that workers do not show progress."""
+    # pylint:disable=global-statement
+    global args, run_stats
+    args = arguments
+    run_stats = telemetry.Telemetry()
+    enable_cache()
+
+
+def enable_cache() -> None:
+    """Cache decoded clouds, if the 'cache' flag is set."""
+    if args.cache is not None:
+        pointcloudfile.enable_cache(args.cache, int(args.cachesize * 2**30))
+
+
+def _init_sweep_worker(arguments: argparse.Namespace, attr_map) -> None:
+    """Set the global args and map for _sweep_setting."""
+    # pylint:disable=global-statement
+    global _sweep_map
+    _init_worker(arguments)
+    _sweep_map = attr_map
+
+
+_sweep_map = None  # type: MapObj
+
+
+def _sweep_setting(job) -> dict:
+    """
+    Label trees and write the analysis for one setting of MapObj.sweep, and
+    return a row of the summary table.
+    """
+    grounddepth, slicedepth, joinedcells, csv_filename = job
+    args.grounddepth = grounddepth
+    args.slicedepth = slicedepth
+    args.joinedcells = joinedcells
+    _sweep_map.trees.clear()
+    _sweep_map.trees.set_many(*_sweep_map._tree_components())
+    heights = np.array(_sweep_map.stream_analysis(csv_filename))
+    row = {'slicedepth': slicedepth, 'joinedcells': joinedcells,
+           'grounddepth': grounddepth, 'trees': heights.size}
+    for name, q in [('height_min', 0), ('height_p25', 25),
+                    ('height_median', 50), ('height_p75', 75),
+                    ('height_max', 100)]:
+        row[name] = np.percentile(heights, q) if heights.size else ''
+    row['height_mean'] = heights.mean() if heights.size else ''
+    row['file'] = os.path.basename(csv_filename)
+    return row
+
+
+def _map_tile(job):
+    """
+    Map a single tile in a worker process, for MapObj.update_spatial_tiled.
+    Returns arrays of (x, y, density, ground, canopy) for the cells in the
+    tile, and of (x, y, label) for tree cells in the tile and band.
+    """
+    fname, (x0, y0, x1, y1), halo, band = job
+    tile = MapObj(fname, colours=False, label=False,
+                  bounds=(x0 - halo, y0 - halo, x1 + halo, y1 + halo))
+    x, y, density = tile.density.to_arrays()
+    core = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+    x, y = x[core], y[core]
+    cells = (x, y, density[core], tile.ground.get_many(x, y),
+             tile.canopy.get_many(x, y))
+    # pylint:disable=protected-access
+    return cells, tile._tree_components(
+        (x0 - band, y0 - band, x1 + band, y1 + band))
 
 
 def get_args():
@@ -387,9 +942,57 @@ def get_args():
     parser.add_argument(  # feature classification
         '--grounddepth', default=0.2, type=float,
         help='depth to omit from sparse point cloud')
+    parser.add_argument(  # performance
+        '--processes', default=1, type=int,
+        help='worker processes; more than one maps the site in tiles')
+    parser.add_argument(  # performance
+        '--tilesize', default=100, type=float,
+        help='tile size in meters when mapping with several processes; '
+        'tiles under twice the halo (about 42m at the default cellsize) '
+        'mostly repeat work')
+    parser.add_argument(  # performance
+        '--index', action='store_true',
+        help='build a spatial index of the input, so regions read faster; '
+        'always done when mapping in tiles')
+    parser.add_argument(  # performance
+        '--fused', action='store_true',
+        help='write sparse cloud, colours and trees in a single pass')
+    parser.add_argument(  # performance
+        '--zorder', action='store_true',
+        help='write the sparse cloud in Morton order of grid cells')
+    parser.add_argument(  # performance
+        '--cache', default=None,
+        help='directory to cache decoded point clouds in, for faster reruns')
+    parser.add_argument(  # performance
+        '--cachesize', default=16, type=float,
+        help='maximum size of the cache in gigabytes')
+    parser.add_argument(  # feature extraction
+        '--sweep', nargs='+', default=None, metavar='NAME=V1,V2',
+        help=('evaluate combinations of slicedepth, joinedcells and '
+              'grounddepth values, eg. "slicedepth=0.4,0.6 joinedcells=2,3";'
+              ' not with --savetrees'))
+    parser.add_argument(  # performance
+        '--report', default=None,
+        help='file to write a JSON report of stage timings and memory to')
+    parser.add_argument(  # performance
+        '--progress', action='store_true',
+        help='show a progress line with throughput and ETA')
     return parser.parse_args()
 
 
+def sweep_values(settings: list) -> dict:
+    """Parse the 'sweep' flag to a dict of parameter name to values."""
+    values = {}
+    for setting in settings:
+        name, _, numbers = setting.partition('=')
+        if name not in ('slicedepth', 'joinedcells', 'grounddepth'):
+            error = 'Cannot sweep over unknown parameter "{}"'.format(name)
+            logging.error(error)
+            raise ValueError(error)
+        values[name] = [float(v) for v in numbers.split(',')]
+    return values
+
+
 def main_processing():
     """
     Logic on which functions to call, and efficient order.
@@ -414,37 +1017,75 @@ def main_processing():
     we create the object using the sparse filename, then the .xyz filename is wrong.
     Confirm what point of this was??
     """
+    # The grid is saved once mapped, so reruns with different tree settings
+    # can skip straight to labelling
+    state_filename = sparse_filename[:-4] + '_grid.npz'
+    if args.index:
+        pointcloudfile.update_index(args.file)
+    trees_saved = False
     if os.path.isfile(sparse_filename):
         logging.info('"sparse" file already exist, using this file')
-        attr_map = MapObj(sparse_filename)
+        with run_stats.stage('map', pointcloudfile.vertex_count(
+                sparse_filename)):
+            attr_map = MapObj(sparse_filename, processes=args.processes,
+                              state=state_filename)
         print('Read {} points into {} cells'.format(
             len(attr_map), len(attr_map.canopy)))
         logging.info('Read {} points into {} cells'.format(
             len(attr_map), len(attr_map.canopy)))
     else:
-        attr_map = MapObj(args.file, colours=False)
+        with run_stats.stage('map', pointcloudfile.vertex_count(args.file)):
+            attr_map = MapObj(args.file, colours=False,
+                              processes=args.processes)
         print('Read {} points into {} cells, writing "{}" ...'.format(
             len(attr_map), len(attr_map.canopy), sparse_filename))
         logging.info('Read {} points into {} cells, writing "{}" ...'.format(
             len(attr_map), len(attr_map.canopy), sparse_filename))
-        attr_map.save_sparse_cloud(sparse_filename)
-        print('Reading colours from ' + sparse_filename)
-        logging.info('Reading colours from {}'.format(sparse_filename))
-        attr_map.update_colours()
+        total = pointcloudfile.vertex_count(attr_map.file)
+        if args.fused:
+            logging.info('Saving sparse cloud, colours and trees in one pass')
+            with run_stats.stage('fused', total):
+                attr_map.save_all_outputs(sparse_filename, zorder=args.zorder)
+            trees_saved = True
+        else:
+            with run_stats.stage('sparse', total):
+                attr_map.save_sparse_cloud(sparse_filename, zorder=args.zorder)
+            print('Reading colours from ' + sparse_filename)
+            logging.info('Reading colours from {}'.format(sparse_filename))
+            with run_stats.stage('colours',
+                                 pointcloudfile.vertex_count(sparse_filename)):
+                attr_map.update_colours()
+    run_stats.count('cells', len(attr_map.density))
+    run_stats.count('tree_cells', len(attr_map.trees))
+    if not attr_map.state_loaded:
+        with run_stats.stage('save_state'):
+            attr_map.save_state(state_filename)
     print('File IO complete, starting analysis...')
     logging.info('File IO complete, starting analysis...')
 
+    if args.sweep:
+        with run_stats.stage('sweep'):
+            summary = attr_map.sweep(
+                sweep_values(args.sweep),
+                sparse_filename[:-4].replace('_sparse', ''), args.processes)
+        print('Wrote summary of parameter sweep to "{}"'.format(summary))
+        logging.info('Wrote summary of parameter sweep to "{}"'.format(summary))
+        return
+
     # table is a string containing the name of the csv file to save tree data in
     table = '{}_analysis.csv'.format(sparse_filename[:-4].replace('_sparse', ''))
     # write the tree data to a csv file
     logging.info('Calling stream_analysis to write the csv file')
-    attr_map.stream_analysis(table)
+    with run_stats.stage('analysis'):
+        run_stats.count('trees', len(attr_map.stream_analysis(table)))
 
     # save pointclouds for individual trees
-    if args.savetrees is not None:
+    if args.savetrees is not None and not trees_saved:
         print('Saving individual trees...')
         logging.info('Saving individual trees')
-        attr_map.save_individual_trees()
+        with run_stats.stage('trees', pointcloudfile.vertex_count(
+                attr_map.file)):
+            attr_map.save_individual_trees()
     print('Done.')
     logging.info('Done.')
 
@@ -502,9 +1143,25 @@ def main():
         if os.path.isfile(args.savetrees):
             logging.error('Output dir for trees is a file; a directory is required.')
             raise IOError('Output dir for trees is a file; a directory is required.')
+        # Each sweep setting labels trees differently
+        if args.savetrees and args.sweep:
+            error = 'Cannot save individual trees in a parameter sweep.'
+            logging.error(error)
+            raise ValueError(error)
 
+    enable_cache()
+    global run_stats
+    run_stats = telemetry.Telemetry(progress=args.progress)
+    # A copy, so the report keeps the requested settings
+    run_stats.info.update(arguments=dict(vars(args)), vertex_count=(
+        pointcloudfile.vertex_count(args.file)))
     logging.info('Commencing main processing function.')
-    main_processing()
+    try:
+        main_processing()
+    finally:
+        if args.report:
+            run_stats.write_report(args.report)
+            logging.info('Wrote run report to "{}"'.format(args.report))
 
 if __name__ == '__main__':
     # Call to get_args is duplicated to work in static analysis, from
@@ -1,15 +1,25 @@
 """
 Tools to read and write georeferenced pointclouds such as output from Pix4D,
 based on the plyfile module.
+
+Large clouds are stored in memmaps of scratch files, managed by
+:py:data:`scratch`.  Set the ``FOREST3D_SCRATCH`` environment variable (or
+``JOBFS``) to put them on fast local storage, and ``FOREST3D_SCRATCH_QUOTA``
+to limit their total size in bytes - or call :py:func:`configure_scratch`.
 """
 
+import atexit
 import collections
+import errno
 import itertools
 import json
+import os
 import tempfile
 import warnings
+import weakref
 
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
 import plyfile
 
 
@@ -17,10 +27,118 @@ UTM_COORD = collections.namedtuple(
     'UTMCoord', ['easting', 'northing', 'zone', 'northern'])
 
 
+class ScratchManager:
+    """Creates the scratch files behind memmaps, and tracks them.
+
+    Files are created in the given directory, or else the one named by the
+    FOREST3D_SCRATCH or JOBFS environment variables, or else the default
+    temporary directory.  The total size of live memmaps is limited to the
+    quota in bytes, if given or set by FOREST3D_SCRATCH_QUOTA.
+
+    Each file is deleted as soon as its memmap is garbage collected (or
+    immediately after mapping where the OS allows), and any left over are
+    deleted when the process exits.
+    """
+
+    def __init__(self, directory=None, quota=None):
+        self.directory = (directory or os.environ.get('FOREST3D_SCRATCH') or
+                          os.environ.get('JOBFS') or None)
+        if quota is None and os.environ.get('FOREST3D_SCRATCH_QUOTA'):
+            quota = int(os.environ['FOREST3D_SCRATCH_QUOTA'])
+        self.quota = quota
+        self.used = 0
+        self._live = {}  # id -> (path, label, nbytes)
+        atexit.register(self.cleanup)
+
+    def tmpfile(self):
+        """Create a temporary file on disk in the scratch directory."""
+        return tempfile.TemporaryFile(dir=self.directory, prefix='geoply-')
+
+    def memmap(self, dtype, shape, label=''):
+        """Return a writeable memmap of the given dtype and shape, backed by
+        a new scratch file.  Raises OSError if it would exceed the quota."""
+        dtype = np.dtype(dtype)
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        if self.quota is not None and self.used + nbytes > self.quota:
+            raise OSError(errno.EDQUOT, 'Scratch quota of {} bytes exceeded '
+                          'by {} byte memmap'.format(self.quota, nbytes))
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='geoply-',
+                                    suffix='.dat')
+        with os.fdopen(fd, 'w+b') as f:
+            mmap = np.memmap(f, dtype=dtype, shape=shape)
+        try:
+            os.remove(path)
+        except OSError:
+            # Eg. Windows cannot delete mapped files; do it when released
+            pass
+        self.used += nbytes
+        key = id(mmap._mmap)  # pylint:disable=protected-access
+        self._live[key] = (path, label, nbytes)
+        # The mmap object lives as long as any view of the memmap
+        weakref.finalize(mmap._mmap,  # pylint:disable=protected-access
+                         self._release, key)
+        return mmap
+
+    def _release(self, key):
+        path, _, nbytes = self._live.pop(key)
+        self.used -= nbytes
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def report(self):
+        """Return a list of (path, label, bytes) for each live memmap."""
+        return sorted(self._live.values())
+
+    def cleanup(self):
+        """Delete any scratch files which have not been released yet."""
+        for path, _, _ in self._live.values():
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+# The scratch manager used for all GeoPly memmaps
+scratch = ScratchManager()
+
+
+def configure_scratch(directory=None, quota=None):
+    """Use a new scratch directory and quota for memmaps created from now
+    on.  Existing memmaps are unaffected."""
+    global scratch  # pylint:disable=global-statement
+    scratch = ScratchManager(directory, quota)
+
+
 def get_tmpfile():
     """Create a temporary file, for easy use of np.memmap"""
-    # TODO:  allow user to specify where this is, eg. $JOBFS
-    return tempfile.SpooledTemporaryFile(max_size=2**20)
+    return scratch.tmpfile()
+
+
+def _is_uniform(column, chunk_size):
+    """Whether every value in the column is the same, checked a chunk at a
+    time so that memory-mapped columns are not loaded at once."""
+    first = column[:1]
+    return all((column[i:i + chunk_size] == first).all()
+               for i in range(0, column.size, chunk_size))
+
+
+def _clean_copy(vertices, names, z_offset, chunk_size):
+    """Copy the named fields of vertices into a scratch memmap a chunk at a
+    time, adding z_offset to the Z coordinate."""
+    dtype = np.dtype([(n, vertices.dtype[n]) for n in names])
+    out = scratch.memmap(dtype, vertices.shape, label='GeoPly.read')
+    for start in range(0, vertices.size, chunk_size):
+        chunk = vertices[start:start + chunk_size]
+        target = out[start:start + chunk_size]
+        for name in names:
+            target[name] = chunk[name]
+        if z_offset:
+            target['z'] += z_offset
+    return out
 
 
 class GeoPly(plyfile.PlyData):
@@ -53,14 +171,14 @@ class GeoPly(plyfile.PlyData):
         if memmap is None:
             memmap = self['vertex'].data.size >= 10**7
         if memmap and not isinstance(self['vertex'].data, np.memmap):
-            mmap = np.memmap(get_tmpfile(), dtype=self['vertex'].data.dtype,
-                             shape=self['vertex'].data.shape)
+            mmap = scratch.memmap(self['vertex'].data.dtype,
+                                  self['vertex'].data.shape, label='GeoPly')
             mmap[:] = self['vertex'].data[:]
             self['vertex'].data = mmap
 
 
     @staticmethod
-    def read(stream):
+    def read(stream, memmap=None, chunk_size=2**20):
         """Reads vertices from ``stream``, with UTM offset and data cleaning.
         stream may be a filename, or a file-like object.
 
@@ -75,27 +193,42 @@ class GeoPly(plyfile.PlyData):
         - discarding non-"vertex" elements (if present)
         - removing the marker comment if written by Meshlab, and if a uniform
           alpha channel was added removing that too
+
+        If stream is the name of a binary file, the vertices are memory-mapped
+        from it when memmap is true, or is None and there are 10**7 or more.
+        If cleaning or the Z-offset change the vertices, they are copied
+        chunk_size at a time into an on-disk scratch file instead, so the
+        cloud is never held in memory.
         """
-        data = plyfile.PlyData.read(stream)
+        data = plyfile.PlyData.read(
+            stream, mmap='c' if memmap is not False else False)
         verts = data['vertex']
+        mapped = isinstance(verts.data, np.memmap)
+        if mapped and memmap is None and verts.data.size < 10**7:
+            verts.data = np.array(verts.data)
+            mapped = False
+
+        # Newer plyfile versions return a copy of the comments
+        comments = list(data.comments)
 
         # Remove meshlab cruft
-        if 'VCGLIB generated' in data.comments:
-            names = verts.data.dtype.names  # field names of each vertex
-            if 'alpha' in names and len(np.unique(verts['alpha'])) == 1:
+        names = verts.data.dtype.names  # field names of each vertex
+        keep = names
+        if 'VCGLIB generated' in comments:
+            if 'alpha' in names and _is_uniform(verts['alpha'], chunk_size):
                 # properties of the PlyElement instance are manually updated
                 verts.properties = [p for p in verts.properties
                                     if p.name != 'alpha']
-                # removal of a vertex field is via fancy indexing
-                verts.data = verts.data[[n for n in names if n != 'alpha']]
-            data.comments.remove('VCGLIB generated')
+                keep = tuple(n for n in names if n != 'alpha')
+            comments.remove('VCGLIB generated')
 
         # Add UTM coordinates if known or discoverable
         utm_coord = None
+        z_offset = 0
         coords = []
-        for c in data.comments:
+        for c in list(comments):
             if c.startswith(GeoPly._COORD_MARKER):
-                data.comments.remove(c)
+                comments.remove(c)
                 serialised = c.lstrip(GeoPly._COORD_MARKER)
                 coords.append(UTM_COORD(**json.loads(serialised)))
         if coords:
@@ -107,25 +240,48 @@ class GeoPly(plyfile.PlyData):
         else:
             # Try to find and apply the Pix4D offset, which may raise...
             z_offset, utm_coord = GeoPly._offset_from_pix4d(stream)
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore', FutureWarning)
-                # Numpy wories about writing to multiple columns here
-                verts['z'] += z_offset
+
+        if mapped and (z_offset or keep != names):
+            verts.data = _clean_copy(verts.data, keep, z_offset, chunk_size)
+        else:
+            if keep != names:
+                # removal of a vertex field is via fancy indexing, packed so
+                # that there are no unnamed gaps in the dtype
+                verts.data = repack_fields(verts.data[list(keep)])
+            if z_offset:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', FutureWarning)
+                    # Numpy wories about writing to multiple columns here
+                    verts['z'] += z_offset
 
         # Return as GeoPly instance with only vertex elements
         return GeoPly([verts], data.text, data.byte_order,
-                      data.comments, data.obj_info, utm_coord=utm_coord)
+                      comments, data.obj_info, utm_coord=utm_coord,
+                      memmap=memmap)
 
 
-    def write(self, stream):
-        """Write to a file, serialising utm_coord as a special comment."""
+    def write(self, stream, chunk_size=2**20):
+        """Write to a file, serialising utm_coord as a special comment.
+
+        Binary files are streamed chunk_size vertices at a time by a
+        :py:class:`GeoPlyWriter`, so memmapped clouds are never loaded at
+        once.  Only the vertex element is written.
+        """
         assert not any(c.startswith(self._COORD_MARKER) for c in self.comments)
         # Serialise as JSON dict following the marker string
         serialised = self._COORD_MARKER + json.dumps(self.utm_coord._asdict())
-        # Insert, write, pop - keeps comments in correct state
-        self.comments.insert(0, serialised)
-        super().write(stream)
-        self.comments.pop(0)
+        if self.text:
+            # Prepend, write, restore - keeps comments in correct state
+            comments = self.comments
+            self.comments = [serialised] + comments
+            super().write(stream)
+            self.comments = comments
+            return
+        data = self['vertex'].data
+        with GeoPlyWriter(stream, data.dtype, self.utm_coord, self.comments,
+                          count=data.size, obj_info=self.obj_info) as writer:
+            for start in range(0, data.size, chunk_size):
+                writer.write(data[start:start + chunk_size])
 
 
     @staticmethod
@@ -175,13 +331,18 @@ class GeoPly(plyfile.PlyData):
 
 
     @classmethod
-    def from_geoplys(cls, *geoplys):
+    def from_geoplys(cls, *geoplys, lazy=False):
         """Create a new geoply by combining two or more GeoPly instances.
 
         All inputs must have compatible georeferences and datatypes.
         The output GeoPly uses the base georeference and comcatenates all
         input vertices, applying relative offsets.  If any of the inputs
-        stored vertices in a np.memmap, so will the output.
+        stored vertices in a np.memmap, or there are 10**7 or more vertices
+        in all, so will the output.
+
+        If lazy is true, return a :py:class:`VirtualGeoPly` instead, which
+        applies the offsets to chunks of the inputs as they are read and
+        never holds a copy of the combined vertices.
         """
         assert len(geoplys) >= 2
         assert all(isinstance(p, cls) for p in geoplys)
@@ -194,22 +355,234 @@ class GeoPly(plyfile.PlyData):
         comments = [c for pf in geoplys for c in pf.comments]
         comments = sorted(set(comments), key=comments.index)
 
-        # paste arrays into single memmap, handling UTM offsets
+        virtual = VirtualGeoPly(geoplys, comments)
+        if lazy:
+            return virtual
         using_memmap = any(isinstance(p['vertex'].data, np.memmap)
                            for p in geoplys)
-        to_arr = (np.memmap if using_memmap else np.array)(
-            get_tmpfile(), dtype=geoplys[0]['vertex'].data.dtype,
-            shape=(sum([p['vertex'].data.size for p in geoplys]),))
-        base, *other_files = geoplys
-        start = base['vertex'].data.size
-        to_arr[:start] = base['vertex'].data
-        for pf in other_files:
-            arr = np.copy(pf['vertex'].data)
-            arr['x'] += (pf.utm_coord.easting - base.utm_coord.easting)
-            arr['y'] += (pf.utm_coord.northing - base.utm_coord.northing)
-            to_arr[start:start+arr.size] = arr
-            start += arr.size
-
-        # Load data back into the complete structure and return
-        return cls(to_arr, comments=comments, utm_coord=base.utm_coord)
+        # None falls back to a memmap for large outputs
+        return virtual.materialise(memmap=using_memmap or None)
+
+
+class VirtualGeoPly:
+    """A lazy concatenation of GeoPly instances, from GeoPly.from_geoplys.
+
+    The vertices of each input are read a chunk at a time, and the easting
+    and northing of its georeference relative to the first are added to
+    each chunk.  Nothing is copied until the vertices are needed: use
+    :py:meth:`chunks` to process them, :py:meth:`write` to stream them to
+    a file, or :py:meth:`materialise` to create a GeoPly.
+    """
+
+    def __init__(self, geoplys, comments=None):
+        base = geoplys[0]
+        self.utm_coord = base.utm_coord
+        self.comments = list(comments or [])
+        self.dtype = base['vertex'].data.dtype
+        self.sources = [
+            (p['vertex'].data,
+             p.utm_coord.easting - base.utm_coord.easting,
+             p.utm_coord.northing - base.utm_coord.northing)
+            for p in geoplys]
+
+    def __len__(self):
+        return sum(data.size for data, _, _ in self.sources)
+
+    def chunks(self, chunk_size=2**20):
+        """Yield arrays of up to chunk_size vertices, with offsets applied."""
+        for data, east, north in self.sources:
+            for start in range(0, data.size, chunk_size):
+                chunk = np.array(data[start:start + chunk_size])
+                if east:
+                    chunk['x'] += east
+                if north:
+                    chunk['y'] += north
+                yield chunk
+
+    def materialise(self, memmap=None, chunk_size=2**20):
+        """Return a GeoPly of the combined vertices, copied a chunk at a time
+        into a scratch memmap if memmap is true (or None and there are
+        10**7 or more vertices), and into memory otherwise."""
+        shape = (len(self),)
+        if memmap is None:
+            memmap = shape[0] >= 10**7
+        if memmap:
+            out = scratch.memmap(self.dtype, shape, label='from_geoplys')
+        else:
+            out = np.empty(shape, dtype=self.dtype)
+        start = 0
+        for chunk in self.chunks(chunk_size):
+            out[start:start + chunk.size] = chunk
+            start += chunk.size
+        return GeoPly(out, comments=self.comments, utm_coord=self.utm_coord,
+                      memmap=memmap)
+
+    def write(self, stream, chunk_size=2**20):
+        """Stream the combined vertices to a binary .ply file, with
+        utm_coord serialised as for GeoPly.write."""
+        with GeoPlyWriter(stream, self.dtype, self.utm_coord, self.comments,
+                          count=len(self)) as writer:
+            for chunk in self.chunks(chunk_size):
+                writer.write(chunk)
+
+
+class GeoPlyWriter:
+    """Write vertices to a binary little-endian GeoPly file a chunk at a time.
+
+    The header, including the UTM_COORD comment, is written first with a
+    padded vertex count which is filled in by :py:meth:`close`, so the
+    number of vertices need not be known in advance.  With append=True,
+    vertices are added to the end of an existing GeoPly file instead -
+    shifted into its georeference if utm_coord differs.  For example, to
+    build a cloud from an iterable of vertices without holding it in
+    memory::
+
+        with GeoPlyWriter('out.ply', dtype, utm_coord) as writer:
+            writer.extend(iterable)
+    """
+    # Characters reserved for the vertex count, so it can be patched
+    _COUNT_WIDTH = 20
 
+    #pylint:disable=too-many-arguments
+    def __init__(self, stream, dtype, utm_coord, comments=None, *,
+                 count=None, append=False, obj_info=None):
+        """
+        Args:
+            stream: a filename, or binary file-like object.  Must be a
+                filename to append, or seekable unless count is given.
+            dtype: the structured dtype of the vertices to write.
+            utm_coord (UTM_COORD): the georeference of the vertices.
+            comments (list): other header comments; ignored if appending.
+            count (int): if known, the exact number of vertices to write.
+            append (bool): if true and the file exists, add to it.
+            obj_info (list): obj_info header lines; ignored if appending.
+        """
+        self.utm_coord = utm_coord
+        self.count = 0
+        self._offset = (0, 0)
+        self._expected = count
+        self._must_close = isinstance(stream, str)
+        if append and self._must_close and os.path.isfile(stream):
+            self._open_append(stream)
+            return
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        if self._must_close:
+            stream = open(stream, 'wb')
+        self.stream = stream
+        serialised = GeoPly._COORD_MARKER + json.dumps(utm_coord._asdict())
+        element = plyfile.PlyElement.describe(
+            np.empty(0, self.dtype), 'vertex')
+        head = ['ply', 'format binary_little_endian 1.0']
+        head += ['comment ' + c for c in [serialised] + list(comments or [])]
+        head += ['obj_info ' + c for c in obj_info or []]
+        start = len('\n'.join(head)) + len('\nelement vertex ')
+        width = 0 if count is not None else self._COUNT_WIDTH
+        head += ['element vertex {:<{}}'.format(count or 0, width)]
+        head += element.header.split('\n')[1:] + ['end_header']
+        self.stream.write(('\n'.join(head) + '\n').encode('ascii'))
+        self._count_at = None if count is not None else start
+
+    def _open_append(self, filename):
+        """Open an existing GeoPly file to append vertices to, first giving
+        it a padded vertex count if it does not have one."""
+        data = plyfile.PlyData.read(filename, mmap='r')
+        if data.text or [e.name for e in data.elements] != ['vertex']:
+            raise ValueError('Can only append to binary files of vertices')
+        coords = [UTM_COORD(**json.loads(c[len(GeoPly._COORD_MARKER):]))
+                  for c in data.comments if c.startswith(GeoPly._COORD_MARKER)]
+        if not coords:
+            raise ValueError('Can only append to a GeoPly file with a '
+                             'UTM_COORD comment')
+        base = coords[0]
+        if (base.zone, base.northern) != (self.utm_coord.zone,
+                                          self.utm_coord.northern):
+            raise ValueError('Cannot append vertices from another UTM zone')
+        self._offset = (self.utm_coord.easting - base.easting,
+                        self.utm_coord.northing - base.northing)
+        self.dtype = data['vertex'].data.dtype
+        self.count = data['vertex'].count
+        del data
+        with open(filename, 'rb') as f:
+            header = b''
+            while not header.endswith(b'end_header\n'):
+                line = f.readline()
+                if not line:
+                    raise ValueError('Unterminated header in ' + filename)
+                header += line
+        start = header.index(b'\nelement vertex ') + len(b'\nelement vertex ')
+        end = header.index(b'\n', start)
+        if end - start < self._COUNT_WIDTH:
+            self._pad_count(filename, header, start, end)
+            end = start + self._COUNT_WIDTH
+        self.stream = open(filename, 'r+b')
+        self.stream.seek(0, os.SEEK_END)
+        self._count_at = start
+
+    def _pad_count(self, filename, header, start, end, chunk_size=2**24):
+        """Rewrite a file with its vertex count padded to _COUNT_WIDTH."""
+        padded = (header[:start] + str(self.count).ljust(
+            self._COUNT_WIDTH).encode('ascii') + header[end:])
+        temp = filename + '.tmp'
+        with open(filename, 'rb') as src, open(temp, 'wb') as dst:
+            src.seek(len(header))
+            dst.write(padded)
+            for block in iter(lambda: src.read(chunk_size), b''):
+                dst.write(block)
+        os.replace(temp, filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        elif self._must_close and self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def write(self, vertices):
+        """Append a structured array of vertices, matching fields by name."""
+        out = np.empty(vertices.shape, dtype=self.dtype)
+        for name in self.dtype.names:
+            out[name] = vertices[name]
+        if self._offset[0]:
+            out['x'] += self._offset[0]
+        if self._offset[1]:
+            out['y'] += self._offset[1]
+        self.stream.write(out.tobytes())
+        self.count += out.size
+
+    def extend(self, iterable, chunk_size=2**16):
+        """Append vertices from an iterable of numpy scalars, as accepted by
+        GeoPly.from_iterable, or of structured arrays, in order."""
+        buffer = []
+        for item in iterable:
+            if isinstance(item, np.ndarray):
+                if buffer:
+                    self.write(np.array(buffer, dtype=buffer[0].dtype))
+                    buffer = []
+                self.write(item)
+                continue
+            buffer.append(item)
+            if len(buffer) >= chunk_size:
+                self.write(np.array(buffer, dtype=buffer[0].dtype))
+                buffer = []
+        if buffer:
+            self.write(np.array(buffer, dtype=buffer[0].dtype))
+
+    def close(self):
+        """Fill in the vertex count, and close the file if we opened it."""
+        if self.stream is None:
+            return
+        try:
+            if self._count_at is not None:
+                self.stream.seek(self._count_at)
+                self.stream.write(str(self.count).encode('ascii'))
+                self.stream.seek(0, os.SEEK_END)
+            elif self.count != self._expected:
+                raise ValueError('Wrote {} vertices, but the header says {}'
+                                 .format(self.count, self._expected))
+        finally:
+            if self._must_close:
+                self.stream.close()
+            self.stream = None
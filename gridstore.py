@@ -0,0 +1,377 @@
+"""
+A compact store for per-cell attributes of a large, sparse 2D grid.
+
+The grid is divided into square tiles of ``tile_size`` cells, and each tile
+is a dense Numpy array which is only allocated when a cell in it is first
+set.  Each attribute is a separate :py:class:`Channel` with its own dtype,
+which behaves like a dict mapping :py:data:`XY_Coord` keys to values, and
+also supports fast vectorised access for arrays of cell indices.
+
+This costs a few bytes per cell per attribute, instead of the 100+ bytes of
+a dict entry keyed by a namedtuple, at the price of allocating whole tiles
+around sparse data.  The tiles of a channel are kept in one stacked array,
+which grows by a quarter when full, so :py:class:`Raster` can look up many
+cells at once without copying them.  :py:class:`TiledGrid` groups channels
+and reports how much memory they use.
+"""
+# pylint:disable=unsubscriptable-object
+
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+import numpy as np
+
+
+XY_Coord = NamedTuple('XY_Coord', [('x', int), ('y', int)])
+TileKey = Tuple[int, int]
+
+# Side length of each tile in cells; 128**2 float64s is 128kB
+TILE_SIZE = 128
+
+
+class Channel(MutableMapping):
+    """
+    A single typed attribute of the grid, mapping cells to values.
+
+    Cells which have never been set are absent, as for a dict - each tile
+    has a boolean mask of present cells alongside the values.  The tiles
+    are views into stacked arrays, in the order they were allocated.
+    """
+
+    def __init__(self, dtype, tile_size: int=TILE_SIZE) -> None:
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.clear()
+
+    def _tile(self, key: TileKey) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the (values, present) arrays for a tile, allocating it if
+        it does not exist yet."""
+        if key not in self._values:
+            slot = len(self._values)
+            if slot == len(self._stack_values):
+                self._grow(slot + slot // 4 + 4)
+            self._values[key] = self._stack_values[slot]
+            self._present[key] = self._stack_present[slot]
+        return self._values[key], self._present[key]
+
+    def __getstate__(self) -> dict:
+        # The tiles are views into the stack, so are rebuilt when unpickled
+        state = dict(self.__dict__)
+        state['_values'] = state['_present'] = list(self._values)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._values = dict(zip(state['_values'], self._stack_values))
+        self._present = dict(zip(state['_present'], self._stack_present))
+
+    def _grow(self, capacity: int) -> None:
+        """Move the tiles to new stacked arrays with room for capacity."""
+        size = (capacity, self.tile_size, self.tile_size)
+        values = np.zeros(size, dtype=self.dtype)
+        present = np.zeros(size, dtype=bool)
+        values[:len(self._values)] = self._stack_values[:len(self._values)]
+        present[:len(self._values)] = self._stack_present[:len(self._values)]
+        self._stack_values, self._stack_present = values, present
+        self._values = dict(zip(self._values, values))
+        self._present = dict(zip(self._present, present))
+
+    def __getitem__(self, key: XY_Coord):
+        x, y = key
+        tile = (x // self.tile_size, y // self.tile_size)
+        present = self._present.get(tile)
+        lx, ly = x % self.tile_size, y % self.tile_size
+        if present is None or not present[lx, ly]:
+            raise KeyError(key)
+        return self._values[tile][lx, ly].item()
+
+    def __setitem__(self, key: XY_Coord, value) -> None:
+        x, y = key
+        values, present = self._tile((x // self.tile_size,
+                                      y // self.tile_size))
+        lx, ly = x % self.tile_size, y % self.tile_size
+        if not present[lx, ly]:
+            present[lx, ly] = True
+            self._count += 1
+        values[lx, ly] = value
+
+    def __delitem__(self, key: XY_Coord) -> None:
+        x, y = key
+        present = self._present.get((x // self.tile_size,
+                                     y // self.tile_size))
+        lx, ly = x % self.tile_size, y % self.tile_size
+        if present is None or not present[lx, ly]:
+            raise KeyError(key)
+        present[lx, ly] = False
+        self._count -= 1
+
+    def __contains__(self, key) -> bool:
+        try:
+            self[key]  # pylint:disable=pointless-statement
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[XY_Coord]:
+        """Iterate over present cells, tile by tile in sorted order."""
+        for key in sorted(self._present):
+            x0, y0 = key[0] * self.tile_size, key[1] * self.tile_size
+            for lx, ly in zip(*np.nonzero(self._present[key])):
+                yield XY_Coord(x0 + int(lx), y0 + int(ly))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def clear(self) -> None:
+        size = (0, self.tile_size, self.tile_size)
+        self._stack_values = np.zeros(size, dtype=self.dtype)
+        self._stack_present = np.zeros(size, dtype=bool)
+        self._values = {}  # type: Dict[TileKey, np.ndarray]
+        self._present = {}  # type: Dict[TileKey, np.ndarray]
+        self._count = 0
+
+    def sum(self):
+        """Return the sum of all present values."""
+        total = 0
+        for key, values in self._values.items():
+            total += values[self._present[key]].sum().item()
+        return total
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes used by the values and masks of all tiles,
+        including room for tiles not yet allocated."""
+        return self._stack_values.nbytes + self._stack_present.nbytes
+
+    def _by_tile(self, cell_x: np.ndarray, cell_y: np.ndarray):
+        """Group arrays of cell indices by tile.  Yields (tile key, index
+        into the input arrays, local x, local y) for each tile touched."""
+        tile_x, local_x = np.divmod(np.asarray(cell_x), self.tile_size)
+        tile_y, local_y = np.divmod(np.asarray(cell_y), self.tile_size)
+        if not tile_x.size:
+            return
+        order = np.lexsort((tile_y, tile_x))
+        tx, ty = tile_x[order], tile_y[order]
+        bounds = np.flatnonzero(np.concatenate(
+            ([True], (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1]), [True])))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            idx = order[start:end]
+            yield ((int(tx[start]), int(ty[start])), idx,
+                   local_x[idx], local_y[idx])
+
+    def get_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                 default=None) -> np.ndarray:
+        """Return an array of the values of the given cells.
+
+        Absent cells take the default value, or raise KeyError if no default
+        is given - just like indexing a dict.
+        """
+        out = np.zeros(np.shape(cell_x), dtype=self.dtype)
+        for key, idx, lx, ly in self._by_tile(cell_x, cell_y):
+            present = self._present.get(key)
+            found = (np.zeros(idx.size, dtype=bool) if present is None
+                     else present[lx, ly])
+            if not found.all():
+                if default is None:
+                    i = idx[~found][0]
+                    raise KeyError(XY_Coord(int(cell_x[i]), int(cell_y[i])))
+                out[idx[~found]] = default
+            if present is not None:
+                out[idx[found]] = self._values[key][lx[found], ly[found]]
+        return out
+
+    def contains_many(self, cell_x: np.ndarray,
+                      cell_y: np.ndarray) -> np.ndarray:
+        """Return a boolean array, true where the given cells are present."""
+        out = np.zeros(np.shape(cell_x), dtype=bool)
+        for key, idx, lx, ly in self._by_tile(cell_x, cell_y):
+            if key in self._present:
+                out[idx] = self._present[key][lx, ly]
+        return out
+
+    def _mark_present(self, present: np.ndarray, lx: np.ndarray,
+                      ly: np.ndarray) -> None:
+        """Set cells present in a tile mask, keeping the count up to date."""
+        before = present.sum()
+        present[lx, ly] = True
+        self._count += int(present.sum() - before)
+
+    def set_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                 values) -> None:
+        """Set the value of each of the given cells."""
+        values = np.broadcast_to(values, np.shape(cell_x))
+        for key, idx, lx, ly in self._by_tile(cell_x, cell_y):
+            tile, present = self._tile(key)
+            tile[lx, ly] = values[idx]
+            self._mark_present(present, lx, ly)
+
+    def _reduce_many(self, ufunc, cell_x, cell_y, values) -> None:
+        """Combine values into cells with ufunc.  Absent cells are set to
+        one of their values first, so the result is exact for any ufunc
+        where combining a value with itself is a no-op (min, max)."""
+        values = np.broadcast_to(values, np.shape(cell_x))
+        for key, idx, lx, ly in self._by_tile(cell_x, cell_y):
+            tile, present = self._tile(key)
+            new = ~present[lx, ly]
+            if new.any():
+                tile[lx[new], ly[new]] = values[idx[new]]
+                self._mark_present(present, lx[new], ly[new])
+            ufunc.at(tile, (lx, ly), values[idx])
+
+    def add_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                 values) -> None:
+        """Add values to the given cells, which may be repeated.  Absent
+        cells are treated as zero."""
+        values = np.broadcast_to(values, np.shape(cell_x))
+        for key, idx, lx, ly in self._by_tile(cell_x, cell_y):
+            tile, present = self._tile(key)
+            new = ~present[lx, ly]
+            if new.any():
+                tile[lx[new], ly[new]] = 0
+                self._mark_present(present, lx[new], ly[new])
+            np.add.at(tile, (lx, ly), values[idx])
+
+    def minimum_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                     values) -> None:
+        """Lower each of the given cells to the minimum of its values."""
+        self._reduce_many(np.minimum, cell_x, cell_y, values)
+
+    def maximum_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                     values) -> None:
+        """Raise each of the given cells to the maximum of its values."""
+        self._reduce_many(np.maximum, cell_x, cell_y, values)
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return (x, y, values) arrays of all present cells, in the same
+        order as iteration."""
+        xs, ys, vals = [], [], []
+        for key in sorted(self._present):
+            lx, ly = np.nonzero(self._present[key])
+            xs.append(lx + key[0] * self.tile_size)
+            ys.append(ly + key[1] * self.tile_size)
+            vals.append(self._values[key][lx, ly])
+        if not xs:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0, dtype=self.dtype)
+        return (np.concatenate(xs).astype(np.int64),
+                np.concatenate(ys).astype(np.int64), np.concatenate(vals))
+
+    def window(self, x0: int, y0: int, width: int,
+               height: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return dense (values, present) arrays for the cells from (x0, y0)
+        to (x0 + width, y0 + height), exclusive.  Absent cells are zero."""
+        values = np.zeros((width, height), dtype=self.dtype)
+        present = np.zeros((width, height), dtype=bool)
+        size = self.tile_size
+        for tx in range(x0 // size, (x0 + width - 1) // size + 1):
+            for ty in range(y0 // size, (y0 + height - 1) // size + 1):
+                if (tx, ty) not in self._values:
+                    continue
+                # Overlap of this tile and the window, in grid coordinates
+                ax, bx = max(x0, tx * size), min(x0 + width, (tx + 1) * size)
+                ay, by = max(y0, ty * size), min(y0 + height, (ty + 1) * size)
+                src = np.s_[ax - tx*size:bx - tx*size,
+                            ay - ty*size:by - ty*size]
+                dst = np.s_[ax - x0:bx - x0, ay - y0:by - y0]
+                values[dst] = self._values[tx, ty][src]
+                present[dst] = self._present[tx, ty][src]
+        return values, present
+
+    def write_window(self, x0: int, y0: int, values: np.ndarray,
+                     mask: np.ndarray) -> None:
+        """Set the cells where mask is true to the corresponding values, with
+        the arrays positioned as for :py:meth:`window`."""
+        lx, ly = np.nonzero(mask)
+        self.set_many(lx + x0, ly + y0, values[lx, ly])
+
+    def tile_keys(self) -> Iterator[TileKey]:
+        """Yield the key of each allocated tile, in sorted order."""
+        yield from sorted(self._values)
+
+    def raster(self) -> 'Raster':
+        """Return a read-only view of the channel for fast lookups."""
+        return Raster(self)
+
+
+class Raster:
+    """
+    A read-only view of a channel, for looking up many cells at once.
+
+    A dense index from tile key to position in the channel's stack of
+    tiles, over the bounding box of allocated tiles, makes
+    :py:meth:`get_many` a single fancy index rather than a sort and a loop
+    over tiles as for :py:meth:`Channel.get_many`.  The tiles are not
+    copied; the index costs four bytes per tile in the bounding box.  Take
+    a new raster after changing the channel.
+    """
+
+    def __init__(self, channel: Channel) -> None:
+        # pylint:disable=protected-access
+        self.tile_size = channel.tile_size
+        self.values = channel._stack_values
+        self.present = channel._stack_present
+        keys = list(channel._values)
+        tiles = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        self.origin = tiles.min(axis=0) if keys else np.zeros(2, np.int64)
+        shape = tiles.max(axis=0) - self.origin + 1 if keys else (0, 0)
+        # Unallocated tiles are -1
+        self.index = np.full(shape, -1, dtype=np.int32)
+        self.index[tuple((tiles - self.origin).T)] = np.arange(len(keys))
+
+    def get_many(self, cell_x: np.ndarray, cell_y: np.ndarray,
+                 default=None) -> np.ndarray:
+        """Return an array of the values of the given cells, with absent
+        cells as for :py:meth:`Channel.get_many`."""
+        tile_x, local_x = np.divmod(np.asarray(cell_x), self.tile_size)
+        tile_y, local_y = np.divmod(np.asarray(cell_y), self.tile_size)
+        tile_x -= self.origin[0]
+        tile_y -= self.origin[1]
+        inside = ((tile_x >= 0) & (tile_x < self.index.shape[0]) &
+                  (tile_y >= 0) & (tile_y < self.index.shape[1]))
+        stack = np.full(tile_x.shape, -1, np.int32)
+        stack[inside] = self.index[tile_x[inside], tile_y[inside]]
+        if not len(self.values):
+            out = np.zeros(stack.shape, dtype=self.values.dtype)
+            found = np.zeros(stack.shape, dtype=bool)
+        else:
+            # Look up unallocated tiles in the first, and mark them absent
+            first = np.maximum(stack, 0)
+            out = self.values[first, local_x, local_y]
+            found = self.present[first, local_x, local_y] & (stack >= 0)
+        if not found.all():
+            if default is None:
+                i = np.flatnonzero(~found)[0]
+                raise KeyError(XY_Coord(int(np.ravel(cell_x)[i]),
+                                        int(np.ravel(cell_y)[i])))
+            out[~found] = default
+        return out
+
+
+class TiledGrid:
+    """
+    A named collection of channels sharing the same tile layout.
+    """
+
+    def __init__(self, tile_size: int=TILE_SIZE) -> None:
+        self.tile_size = tile_size
+        self.channels = {}  # type: Dict[str, Channel]
+
+    def add_channel(self, name: str, dtype) -> Channel:
+        """Create (or replace) the named channel, and return it."""
+        self.channels[name] = Channel(dtype, self.tile_size)
+        return self.channels[name]
+
+    def __getitem__(self, name: str) -> Channel:
+        return self.channels[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.channels
+
+    @property
+    def nbytes(self) -> int:
+        """Total bytes of tile memory used by all channels."""
+        return sum(c.nbytes for c in self.channels.values())
+
+    def memory_report(self) -> Dict[str, int]:
+        """Return a dict of the bytes of tile memory used by each channel."""
+        return {name: c.nbytes for name, c in self.channels.items()}
@@ -0,0 +1,420 @@
+"""
+Build a level-of-detail octree of a GeoPly cloud, for fast previews.
+
+The cube around the cloud is the root node, and each node with too many
+points is divided into eight octants.  Every node holds one point from
+each cell of a ``resolution**3`` voxel grid over its cube, taken from the
+points of its children - so the root is a coarse but even sample of the
+whole site, and each level adds detail to the levels above.  Leaves hold
+the remaining points, and no point is stored twice.  To preview down to
+any depth, load the nodes with :py:func:`read_level`.
+
+The octree is a directory of GeoPly files named for the path to each node
+(``r.ply``, ``r0.ply``, ``r07.ply``, ...; each digit is the octant, with
+bits for x, y and z), all with the georeference of the input, and an
+``octree.json`` file of metadata and the point count of each node.
+
+:py:func:`build` works out-of-core.  It reads the input twice, a chunk at
+a time: first to count points in a fine grid and so decide how to divide
+the cube, then to sort points into the nodes which need not be divided
+further.  Memory use is bounded by the buffer for these files and the
+points of a few nodes, and nodes are processed in parallel from the
+leaves up, each reading at most its eight children.  From a script::
+
+    from forest3D import octree
+    octree.main()  # eg. site.ply site_octree --processes 8
+"""
+# pylint:disable=unsubscriptable-object
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+from typing import Callable, Dict, Iterator, List, Set, Tuple
+
+import numpy as np
+
+from . import geoply
+
+
+# Nodes are divided no deeper than this, even if they have too many points
+MAX_DEPTH = 20
+
+# Name of the metadata file in an octree directory
+METADATA = 'octree.json'
+
+# Origin and side length of the cube of a node
+Cube = Tuple[np.ndarray, float]
+
+
+def _source(source, chunk_size: int) -> Tuple[geoply.UTM_COORD, np.dtype,
+                                               Callable[[], Iterator]]:
+    """Return the georeference, vertex dtype, and a function to iterate
+    over chunks of vertices, for a GeoPly, VirtualGeoPly or filename."""
+    if isinstance(source, str):
+        source = geoply.GeoPly.read(source, memmap=True)
+    if isinstance(source, geoply.VirtualGeoPly):
+        return (source.utm_coord, source.dtype,
+                lambda: source.chunks(chunk_size))
+    data = source['vertex'].data
+    return (source.utm_coord, data.dtype,
+            lambda: (data[i:i + chunk_size]
+                     for i in range(0, data.size, chunk_size)))
+
+
+def _cells(points: np.ndarray, cube: Cube, count: int
+           ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the x, y, and z indices of the cell of each point, in a grid
+    of count**3 cells over the cube."""
+    origin, size = cube
+    i, j, k = (np.clip(np.floor((points[axis] - origin[n]) / size * count),
+                       0, count - 1).astype(np.int64)
+               for n, axis in enumerate('xyz'))
+    return i, j, k
+
+
+def _child_cube(cube: Cube, octant: int) -> Cube:
+    """Return the cube of an octant of the given cube."""
+    origin, size = cube
+    corner = np.array([octant >> 2, octant >> 1 & 1, octant & 1])
+    return origin + size / 2 * corner, size / 2
+
+
+def node_cube(name: str, root: Cube) -> Cube:
+    """Return the origin and side length of the named node, in an octree
+    with the given root cube."""
+    cube = (np.asarray(root[0], dtype=np.float64), root[1])
+    for digit in name[1:]:
+        cube = _child_cube(cube, int(digit))
+    return cube
+
+
+def _node_name(level: int, i: int, j: int, k: int) -> str:
+    """Return the name of the node with the given cell indices at level."""
+    return 'r' + ''.join(
+        str((i >> b & 1) << 2 | (j >> b & 1) << 1 | k >> b & 1)
+        for b in reversed(range(level)))
+
+
+def _node_file(directory: str, name: str) -> str:
+    return os.path.join(directory, name + '.ply')
+
+
+def _read_node(directory: str, name: str) -> np.ndarray:
+    return geoply.GeoPly.read(_node_file(directory, name))['vertex'].data
+
+
+def _write_node(directory: str, name: str, points: np.ndarray,
+                utm_coord: geoply.UTM_COORD) -> None:
+    with geoply.GeoPlyWriter(_node_file(directory, name), points.dtype,
+                             utm_coord, count=points.size) as writer:
+        writer.write(points)
+
+
+def _sample(parts: List[np.ndarray], cube: Cube, resolution: int
+            ) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Take the first point in each voxel of a resolution**3 grid over the
+    cube from the concatenated parts, and return the sample and what is
+    left of each part."""
+    points = np.concatenate(parts)
+    i, j, k = _cells(points, cube, resolution)
+    _, first = np.unique((i * resolution + j) * resolution + k,
+                         return_index=True)
+    taken = np.zeros(points.size, dtype=bool)
+    taken[first] = True
+    bounds = np.cumsum([0] + [p.size for p in parts])
+    rest = [points[start:end][~taken[start:end]]
+            for start, end in zip(bounds[:-1], bounds[1:])]
+    return points[taken], rest
+
+
+def _subtree(points: np.ndarray, name: str, cube: Cube, max_points: int,
+             resolution: int) -> Dict[str, np.ndarray]:
+    """Divide the points of a node in memory until each leaf has at most
+    max_points, and return the points of each node in the subtree."""
+    if points.size <= max_points or len(name) > MAX_DEPTH:
+        return {name: points}
+    i, j, k = _cells(points, cube, 2)
+    octant = i << 2 | j << 1 | k
+    nodes = {}  # type: Dict[str, np.ndarray]
+    children = [name + str(o) for o in np.unique(octant)]
+    for child in children:
+        nodes.update(_subtree(points[octant == int(child[-1])], child,
+                              _child_cube(cube, int(child[-1])),
+                              max_points, resolution))
+    nodes[name], rest = _sample([nodes[c] for c in children], cube,
+                                resolution)
+    nodes.update(zip(children, rest))
+    return nodes
+
+
+class _NodeBuffers:
+    """Write chunks of points to many node files, buffering up to memory
+    bytes and then flushing the largest buffers until half is free.  Each
+    file is replaced by the first flush, and appended to after that."""
+
+    def __init__(self, directory: str, utm_coord: geoply.UTM_COORD,
+                 memory: int) -> None:
+        self.directory = directory
+        self.utm_coord = utm_coord
+        self.memory = memory
+        self.buffered = 0
+        self._buffers = {}  # type: Dict[str, List[np.ndarray]]
+        self._started = set()  # type: Set[str]
+
+    def write(self, name: str, points: np.ndarray) -> None:
+        self._buffers.setdefault(name, []).append(points)
+        self.buffered += points.nbytes
+        if self.buffered > self.memory:
+            for name in sorted(self._buffers, reverse=True, key=lambda n: sum(
+                    p.nbytes for p in self._buffers[n])):
+                self._flush(name)
+                if self.buffered <= self.memory // 2:
+                    break
+
+    def _flush(self, name: str) -> None:
+        parts = self._buffers.pop(name)
+        with geoply.GeoPlyWriter(_node_file(self.directory, name),
+                                 parts[0].dtype, self.utm_coord,
+                                 append=name in self._started) as writer:
+            self._started.add(name)
+            for points in parts:
+                writer.write(points)
+                self.buffered -= points.nbytes
+
+    def close(self) -> None:
+        for name in list(self._buffers):
+            self._flush(name)
+
+
+def _bounds(chunks: Iterator[np.ndarray]) -> Tuple[Cube, int]:
+    """Return the cube around all points, and the number of points."""
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    total = 0
+    for chunk in chunks:
+        if not chunk.size:
+            continue
+        total += chunk.size
+        for n, axis in enumerate('xyz'):
+            low[n] = min(low[n], chunk[axis].min())
+            high[n] = max(high[n], chunk[axis].max())
+    if not total:
+        raise ValueError('Cannot build an octree of an empty cloud')
+    # Slightly larger, so that the highest points are inside the cube
+    size = float((high - low).max()) * (1 + 1e-6) or 1.
+    return (low, size), total
+
+
+def _partition(chunks: Iterator[np.ndarray], root: Cube, max_points: int,
+               depth: int) -> Tuple[np.ndarray, List[str], Set[str]]:
+    """
+    Count points in a grid of 2**depth cells a side, and divide nodes with
+    more than max_points.  Return the index of the undivided node of each
+    grid cell, the names of the undivided nodes, and the names of the
+    divided nodes.
+    """
+    side = 2**depth
+    counts = np.zeros(side**3, dtype=np.int64)
+    for chunk in chunks:
+        i, j, k = _cells(chunk, root, side)
+        counts += np.bincount((i * side + j) * side + k, minlength=side**3)
+    # The counts of each level, from the root down
+    levels = [counts.reshape(side, side, side)]
+    while levels[0].shape[0] > 1:
+        half = levels[0].shape[0] // 2
+        levels.insert(0, levels[0].reshape(half, 2, half, 2, half, 2)
+                      .sum(axis=(1, 3, 5)))
+    owner = np.zeros((side, side, side), dtype=np.int32)
+    leaves = []  # type: List[str]
+    divided = set()  # type: Set[str]
+    stack = [(0, 0, 0, 0)]
+    while stack:
+        level, i, j, k = stack.pop()
+        if not levels[level][i, j, k]:
+            continue
+        if levels[level][i, j, k] > max_points and level < depth:
+            divided.add(_node_name(level, i, j, k))
+            stack.extend((level + 1, 2 * i + (o >> 2), 2 * j + (o >> 1 & 1),
+                          2 * k + (o & 1)) for o in range(8))
+            continue
+        scale = 2**(depth - level)
+        owner[i * scale:(i + 1) * scale, j * scale:(j + 1) * scale,
+              k * scale:(k + 1) * scale] = len(leaves)
+        leaves.append(_node_name(level, i, j, k))
+    return owner, leaves, divided
+
+
+def _build_leaf(job: tuple) -> Dict[str, int]:
+    """Divide a node file in memory if it has too many points, and write
+    the nodes of its subtree.  Return the point count of each node."""
+    directory, name, root, max_points, resolution, utm_coord = job
+    utm_coord = geoply.UTM_COORD(**utm_coord)
+    points = _read_node(directory, name)
+    if points.size <= max_points:
+        return {name: points.size}
+    nodes = _subtree(points, name, node_cube(name, root), max_points,
+                     resolution)
+    for node, node_points in nodes.items():
+        _write_node(directory, node, node_points, utm_coord)
+    return {node: p.size for node, p in nodes.items()}
+
+
+def _build_parent(job: tuple) -> Dict[str, int]:
+    """Sample the points of a node from its children, rewriting them
+    without the sampled points.  Return the point count of each node."""
+    directory, name, children, root, resolution, utm_coord = job
+    utm_coord = geoply.UTM_COORD(**utm_coord)
+    parts = [_read_node(directory, c) for c in children]
+    points, rest = _sample(parts, node_cube(name, root), resolution)
+    _write_node(directory, name, points, utm_coord)
+    counts = {name: points.size}
+    for child, part, left in zip(children, parts, rest):
+        if left.size != part.size:
+            _write_node(directory, child, left, utm_coord)
+        counts[child] = left.size
+    return counts
+
+
+def _map(func: Callable, jobs: list, processes: int) -> Iterator:
+    """Map func over jobs, in a pool of worker processes if more than one."""
+    if processes > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            yield from pool.imap_unordered(func, jobs)
+    else:
+        yield from map(func, jobs)
+
+
+def _remove_old(directory: str) -> None:
+    """Remove the node files of an octree previously built in directory."""
+    fname = os.path.join(directory, METADATA)
+    if not os.path.isfile(fname):
+        return
+    with open(fname) as f:
+        nodes = json.load(f)['nodes']
+    for name in nodes:
+        if os.path.isfile(_node_file(directory, name)):
+            os.remove(_node_file(directory, name))
+    os.remove(fname)
+
+
+def build(source, directory: str, max_points: int=10**5,
+          resolution: int=128, processes: int=1, memory: int=2**28,
+          grid_depth: int=7, chunk_size: int=2**20) -> dict:
+    """
+    Build a level-of-detail octree of the source cloud in directory.
+
+    Args:
+        source: a GeoPly or VirtualGeoPly, or the name of a .ply file to
+            read with GeoPly.read.
+        directory (str): where to write the octree; replaces any octree
+            already built there.
+        max_points (int): divide nodes with more than this many points.
+        resolution (int): each node holds a point from each cell of a grid
+            of this many cells a side, so coarse levels are about
+            ``size / resolution`` apart.
+        processes (int): worker processes to build nodes in parallel.
+        memory (int): bytes to buffer while sorting points into nodes.
+        grid_depth (int): cells a side of the grid used to count points
+            are ``2**grid_depth``.  Nodes of that depth with more than
+            max_points are divided further in memory.
+        chunk_size (int): vertices to read from the source at once.
+
+    Returns:
+        The metadata written to ``octree.json``.
+    """
+    utm_coord, dtype, chunks = _source(source, chunk_size)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _remove_old(directory)
+    root, total = _bounds(chunks())
+    owner, leaves, divided = _partition(chunks(), root, max_points,
+                                        grid_depth)
+    logging.info('Sorting {:,} points into {} octree nodes'.format(
+        total, len(leaves)))
+    side = 2**grid_depth
+    buffers = _NodeBuffers(directory, utm_coord, memory)
+    for chunk in chunks():
+        index = owner[_cells(chunk, root, side)]
+        order = np.argsort(index, kind='stable')
+        found, starts = np.unique(index[order], return_index=True)
+        for leaf, part in zip(found, np.split(chunk[order], starts[1:])):
+            buffers.write(leaves[leaf], part)
+    buffers.close()
+
+    # UTM_COORD cannot be pickled for worker processes, but a dict can
+    utm = dict(utm_coord._asdict())
+    counts = {}  # type: Dict[str, int]
+    jobs = [(directory, name, root, max_points, resolution, utm)
+            for name in leaves]
+    for result in _map(_build_leaf, jobs, processes):
+        counts.update(result)
+    # Sample each divided node from its children, from the deepest up
+    for level in range(max(map(len, divided), default=0), 0, -1):
+        children = {}  # type: Dict[str, List[str]]
+        for node in sorted(n for n in counts if len(n) == level + 1):
+            children.setdefault(node[:-1], []).append(node)
+        jobs = [(directory, name, children[name], root, resolution, utm)
+                for name in sorted(divided) if len(name) == level]
+        for result in _map(_build_parent, jobs, processes):
+            counts.update(result)
+
+    metadata = {
+        'utm_coord': utm_coord._asdict(),
+        'origin': root[0].tolist(),
+        'size': root[1],
+        'resolution': resolution,
+        'spacing': root[1] / resolution,
+        'points': total,
+        'depth': max(map(len, counts)) - 1,
+        'fields': list(dtype.names),
+        'nodes': dict(sorted(counts.items())),
+    }
+    temp = os.path.join(directory, METADATA + '.tmp')
+    with open(temp, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(temp, os.path.join(directory, METADATA))
+    logging.info('Wrote octree of {} nodes, {} deep, to {}'.format(
+        len(counts), metadata['depth'], directory))
+    return metadata
+
+
+def read_level(directory: str, depth: int, **kwargs) -> geoply.GeoPly:
+    """Return a GeoPly of the points of all nodes of the octree in
+    directory down to the given depth, where the root is depth zero.
+    Keyword arguments are passed to GeoPly."""
+    with open(os.path.join(directory, METADATA)) as f:
+        metadata = json.load(f)
+    names = [n for n, count in metadata['nodes'].items()
+             if len(n) <= depth + 1 and count]
+    points = np.concatenate([_read_node(directory, n) for n in names])
+    return geoply.GeoPly(points, utm_coord=geoply.UTM_COORD(
+        **metadata['utm_coord']), **kwargs)
+
+
+def main() -> None:
+    """Command-line interface to build an octree."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input', help='a GeoPly or Pix4D .ply file')
+    parser.add_argument('output', help='directory to write the octree to')
+    parser.add_argument(
+        '--maxpoints', default=10**5, type=int,
+        help='divide octree nodes with more than this many points')
+    parser.add_argument(
+        '--resolution', default=128, type=int,
+        help='sample points per side of each node, for coarser levels')
+    parser.add_argument(
+        '--processes', default=1, type=int,
+        help='worker processes to build nodes in parallel')
+    parser.add_argument(
+        '--memory', default=256, type=int,
+        help='MB to buffer while sorting points into nodes')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    build(opts.input, opts.output, opts.maxpoints, opts.resolution,
+          opts.processes, opts.memory * 2**20)
+
+
+if __name__ == '__main__':
+    main()
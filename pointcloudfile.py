@@ -3,10 +3,20 @@
 
 Most uses of this module should go through :py:func:`read` to iterate over
 points in the file, or :py:func:`write` to save an iterable of points.
-Neither function accumulates much data in memory.
+Neither function accumulates much data in memory.  :py:func:`read_chunks`
+yields the same points as Numpy structured arrays of many points at a time,
+which is much faster for vectorised processing of large clouds, and
+:py:func:`open_mmap` gives zero-copy random access to the vertices of a file.
+Both can read only the points in a bounding box, which is fast if the file
+has a sidecar index from :py:func:`build_index`.  After
+:py:func:`enable_cache`, decoded clouds are cached on disk and memory-mapped
+when read again.
 
 :py:class:`IncrementalWriter` is useful when accumulating data in memory to
-write many files is impractical.  :py:func:`offset_for` and
+write many files is impractical, and can write points in Morton (Z-order)
+of grid cells so that nearby points are stored together.
+:py:class:`WriterPool` writes chunks of points to thousands of files at once
+with bounded memory and open files.  :py:func:`offset_for` and
 :py:func:`read_header` provide location metadata if possible.
 
 In all cases a "point" is tuple of (x, y, z, r, g, b).  XYZ are floats denoting
@@ -17,14 +27,21 @@ format easily enough.
 # Pylint can freak out about mypy type notation; it's fine at runtime
 # pylint:disable=unsubscriptable-object,invalid-sequence-index
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 import itertools
+import math
 import struct
 import os.path
+from queue import Full, Queue
 from tempfile import SpooledTemporaryFile
-from typing import Iterator, List, NamedTuple, Tuple
+import threading
+from typing import Callable, Dict, Iterator, List, NamedTuple, Set, Tuple
 import logging
 
+import numpy as np
+
+from . import columncache
+
 
 # User-defined types:
 Point = Tuple[float, ...]
@@ -33,6 +50,8 @@ PlyHeader = NamedTuple('PlyHeader', [
     ('form_str', str), ('comments', Tuple[str, ...])])
 UTM_Coord = NamedTuple('UTM_Coord', [
     ('x', float), ('y', float), ('zone', int), ('north', bool)])
+# (min x, min y, max x, max y), inclusive
+BBox = Tuple[float, float, float, float]
 
 # The various struct types of .ply binary format
 PLY_TYPES = {'float': 'f', 'double': 'd', 'uchar': 'B', 'char': 'b',
@@ -69,23 +88,388 @@ def _check_input(fname, ending='.ply'):
             fname[-4:], ending))
 
 
-def read(fname: str) -> Iterator:
-    """Passes the file to a read function for that format."""
-    if fname.endswith('_point_cloud_part_1.ply'):
-        parts, p = [fname], 1
-        stub = fname.replace('_point_cloud_part_1.ply', '')
-        while True:
-            p += 1
-            part = stub + '_point_cloud_part_{}.ply'.format(p)
-            if os.path.isfile(part):
-                parts.append(part)
-            else:
-                return _read_pix4d_ply_parts(parts)
-    return _read_ply(fname)
+def _pix4d_parts(fname: str) -> List[str]:
+    """Return the list of Pix4D part files starting with fname, or an empty
+    list if fname is not the first part of a multi-part pointcloud."""
+    if not fname.endswith('_point_cloud_part_1.ply'):
+        return []
+    parts, p = [fname], 1
+    stub = fname.replace('_point_cloud_part_1.ply', '')
+    while True:
+        p += 1
+        part = stub + '_point_cloud_part_{}.ply'.format(p)
+        if not os.path.isfile(part):
+            return parts
+        parts.append(part)
+
 
+def read(fname: str, bbox: BBox=None) -> Iterator:
+    """Yield each point in the file as a namedtuple.
 
-def _read_pix4d_ply_parts(fname_list: List[str]) -> Iterator:
-    """Yield points from a list of Pix4D ply files as if they were one file.
+    This is a compatibility layer over :py:func:`read_chunks`, which should
+    be preferred for anything performance-sensitive.
+    """
+    point = None
+    for chunk in read_chunks(fname, bbox=bbox):
+        if point is None:
+            point = namedtuple('Point', chunk.dtype.names)  # type: ignore
+        yield from map(point._make, chunk.tolist())  # type: ignore
+
+
+def read_chunks(fname: str, chunk_points: int=2**20,
+                bbox: BBox=None) -> Iterator[np.ndarray]:
+    """Yield the points in the file as structured arrays of up to
+    ``chunk_points`` vertices, with one field per vertex property.
+
+    Pix4D multi-part clouds are read as if they were a single file, in which
+    case x, y and z are widened to float64 to keep the precision of the
+    offset correction, and a background thread reads ahead - into the next
+    part if need be - while each chunk is processed.  Chunks keep the byte
+    order of the file.
+
+    If bbox is given, only points inside it are yielded.  Files with an
+    up-to-date index from :py:func:`build_index` only read the records which
+    may be in the box; otherwise the whole file is read and filtered.
+
+    If the cache is enabled, clouds which have been read in full before are
+    read from the cache instead, and other full reads populate it.
+    """
+    parts = _pix4d_parts(fname)
+    if parts:
+        chunks = _read_pix4d_ply_parts(parts, chunk_points, bbox)
+    else:
+        chunks = _read_ply(fname, chunk_points, bbox)
+    if _cache is None:
+        yield from chunks
+        return
+    sources = parts or [fname]
+    prints = fingerprints(fname)
+    columns = _cache.lookup(sources, prints)
+    if columns is not None:
+        chunks.close()
+        yield from _read_columns(columns, chunk_points, bbox)
+    elif bbox is None:
+        yield from _cache.store(sources, prints, chunks, vertex_count(fname))
+    else:
+        yield from chunks
+
+
+# The cache of decoded clouds, if enabled
+_cache = None  # type: columncache.ColumnCache
+
+
+def enable_cache(directory: str, max_bytes: int=2**34) -> None:
+    """Cache decoded clouds as memory-mappable columns in directory, using
+    at most about max_bytes of disk.  Disable the cache if directory is
+    None."""
+    # pylint:disable=global-statement
+    global _cache
+    _cache = None if directory is None else \
+        columncache.ColumnCache(directory, max_bytes)
+
+
+def _read_columns(columns, chunk_points: int,
+                  bbox: BBox=None) -> Iterator[np.ndarray]:
+    """Yield chunks of points from a dict of cached columns."""
+    dtype = np.dtype([(name, col.dtype) for name, col in columns.items()])
+    count = len(next(iter(columns.values())))
+    for start in range(0, count, chunk_points):
+        stop = min(start + chunk_points, count)
+        chunk = np.empty(stop - start, dtype=dtype)
+        for name, col in columns.items():
+            chunk[name] = col[start:stop]
+        if bbox is not None:
+            chunk = _in_bbox(chunk, bbox)
+        if chunk.size:
+            yield chunk
+
+
+def _in_bbox(chunk: np.ndarray, bbox: BBox) -> np.ndarray:
+    """Return the points in chunk which are inside bbox."""
+    x_min, y_min, x_max, y_max = bbox
+    x, y = chunk['x'], chunk['y']
+    return chunk[(x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)]
+
+
+def fingerprint(fname: str) -> Tuple[int, int]:
+    """Return the (size, mtime in nanoseconds) of a file, which change
+    whenever the file is rewritten."""
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def vertex_count(fname: str) -> int:
+    """Return the number of vertices in a file, or in all parts of a Pix4D
+    multi-part cloud, from the headers."""
+    return sum(parse_ply_header(ply_header_text(f)).vertex_count
+               for f in _pix4d_parts(fname) or [fname])
+
+
+def fingerprints(fname: str) -> List[Tuple[int, int]]:
+    """Return the fingerprint of a file, or of each part of a Pix4D
+    multi-part cloud, as a list."""
+    return [fingerprint(f) for f in _pix4d_parts(fname) or [fname]]
+
+
+def index_filename(fname: str) -> str:
+    """Return the name of the sidecar index file for a .ply file."""
+    return fname[:-4] + '_ply_index.npz'
+
+
+def build_index(fname: str, tile_size: float=10.0,
+                chunk_points: int=2**20) -> str:
+    """Build a sidecar spatial index for a single .ply file, and return the
+    filename of the index.
+
+    The index records which ranges of vertex records hold the points in
+    each square tile of ``tile_size``, and is keyed on the size and
+    modification time of the file.  Region reads are fastest when points
+    are spatially ordered, so that each tile is a few contiguous ranges.
+    """
+    tiles_x, tiles_y, starts, stops = [], [], [], []
+    offset = 0
+    for chunk in _read_ply(fname, chunk_points):
+        tx = np.floor(chunk['x'] / tile_size).astype(np.int64)
+        ty = np.floor(chunk['y'] / tile_size).astype(np.int64)
+        # Start of each run of consecutive points in the same tile
+        run = np.flatnonzero(np.concatenate(
+            ([True], (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1]))))
+        tiles_x.append(tx[run])
+        tiles_y.append(ty[run])
+        starts.append(run + offset)
+        stops.append(np.append(run[1:], tx.size) + offset)
+        offset += tx.size
+    if starts:
+        tx, ty = np.concatenate(tiles_x), np.concatenate(tiles_y)
+        start, stop = np.concatenate(starts), np.concatenate(stops)
+    else:
+        tx = ty = start = stop = np.empty(0, dtype=np.int64)
+    # Group runs by tile, and join runs split across chunks
+    order = np.lexsort((start, ty, tx))
+    tx, ty, start, stop = tx[order], ty[order], start[order], stop[order]
+    new_tile = np.concatenate(
+        ([True], (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1])))
+    new_run = new_tile.copy()
+    new_run[1:] |= start[1:] != stop[:-1]
+    keep = np.flatnonzero(new_run)
+    stop = stop[np.append(keep[1:], stop.size) - 1] if stop.size else stop
+    tx, ty, start, new_tile = tx[keep], ty[keep], start[keep], new_tile[keep]
+    first = np.flatnonzero(new_tile)
+    index = index_filename(fname)
+    with open(index, 'wb') as f:
+        np.savez(f, fingerprint=np.array(fingerprint(fname), dtype=np.int64),
+                 tile_size=tile_size, tiles=np.stack([tx[first], ty[first]], 1),
+                 offsets=np.append(first, start.size), starts=start,
+                 stops=stop)
+    logging.info('Built index "{}" of {} runs in {} tiles'.format(
+        index, start.size, first.size))
+    return index
+
+
+def update_index(fname: str, tile_size: float=10.0) -> None:
+    """Build the sidecar index of fname - or of each part of a Pix4D
+    multi-part cloud - unless an up-to-date index already exists."""
+    for part in _pix4d_parts(fname) or [fname]:
+        _check_input(part)
+        if _load_index(part) is None:
+            build_index(part, tile_size)
+
+
+def index_bbox(fname: str) -> BBox:
+    """Return a box around all points of fname - or of a Pix4D multi-part
+    cloud, offset as by :py:func:`read_chunks` - from the sidecar index,
+    rounded out to whole index tiles.  Raises ValueError if any part has no
+    up-to-date index."""
+    parts = _pix4d_parts(fname) or [fname]
+    ox, oy, _ = offset_for(parts[0]) if len(parts) > 1 else (0, 0, 0)
+    boxes = []
+    for part in parts:
+        index = _load_index(part)
+        if index is None:
+            error = 'No up-to-date index for "{}"'.format(part)
+            logging.error(error)
+            raise ValueError(error)
+        if not index['tiles'].size:
+            continue
+        dx, dy, _ = offset_for(part) if len(parts) > 1 else (0, 0, 0)
+        size = float(index['tile_size'])
+        low = index['tiles'].min(axis=0) * size
+        high = (index['tiles'].max(axis=0) + 1) * size
+        boxes.append((float(low[0] + dx - ox), float(low[1] + dy - oy),
+                      float(high[0] + dx - ox), float(high[1] + dy - oy)))
+    if not boxes:
+        return 0., 0., -1., -1.
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def scan_bbox(fname: str) -> BBox:
+    """Return the exact box around all points of fname, as for
+    :py:func:`index_bbox` but by reading the whole file.  For clouds which
+    have no index, and where one cannot be written."""
+    low, high = [math.inf, math.inf], [-math.inf, -math.inf]
+    for chunk in read_chunks(fname):
+        if not chunk.size:
+            continue
+        for axis, name in enumerate('xy'):
+            low[axis] = min(low[axis], float(chunk[name].min()))
+            high[axis] = max(high[axis], float(chunk[name].max()))
+    if low[0] > high[0]:
+        return 0., 0., -1., -1.
+    return low[0], low[1], high[0], high[1]
+
+
+def _load_index(fname: str):
+    """Return the sidecar index of a .ply file as a dict of arrays, or None
+    if there is no index or it is out of date."""
+    index = index_filename(fname)
+    if not os.path.isfile(index):
+        return None
+    with np.load(index) as data:
+        if tuple(data['fingerprint']) != fingerprint(fname):
+            logging.info('Ignoring out of date index "{}"'.format(index))
+            return None
+        return {k: data[k] for k in data.files}
+
+
+def _index_ranges(index: dict, bbox: BBox,
+                  gap: int=0) -> List[Tuple[int, int]]:
+    """Return sorted, non-overlapping (start, stop) record ranges which
+    hold every point in bbox according to the index.  Ranges separated by
+    less than gap records are joined, as reading a few unwanted records is
+    much faster than seeking past them."""
+    x_min, y_min, x_max, y_max = (
+        math.floor(v / index['tile_size']) for v in bbox)
+    tiles, offsets = index['tiles'], index['offsets']
+    selected = np.flatnonzero(
+        (tiles[:, 0] >= x_min) & (tiles[:, 0] <= x_max) &
+        (tiles[:, 1] >= y_min) & (tiles[:, 1] <= y_max))
+    if not selected.size:
+        return []
+    runs = np.concatenate([np.arange(offsets[i], offsets[i+1])
+                           for i in selected])
+    order = np.argsort(index['starts'][runs], kind='stable')
+    starts, stops = index['starts'][runs][order], index['stops'][runs][order]
+    # A new range begins wherever a run starts after all previous runs end
+    ends = np.maximum.accumulate(stops)
+    first = np.flatnonzero(
+        np.concatenate(([True], starts[1:] > ends[:-1] + gap)))
+    last = np.append(first[1:], starts.size) - 1
+    return list(zip(starts[first].tolist(), ends[last].tolist()))
+
+
+def open_mmap(fname: str) -> np.memmap:
+    """Return a read-only structured memmap over the vertices in the file.
+
+    Nothing is read until the array is indexed, so slicing, strided sampling
+    or fancy indexing of a multi-gigabyte cloud only touches the data used.
+    Unlike :py:func:`read_chunks`, only the given file is mapped and any
+    Pix4D offsets are *not* applied to the coordinates.
+    """
+    header_bytes = ply_header_text(fname)
+    header = parse_ply_header(header_bytes)
+    return np.memmap(fname, dtype=vertex_dtype(header), mode='r',
+                     offset=len(header_bytes), shape=(header.vertex_count,))
+
+
+def vertex_dtype(header: PlyHeader) -> np.dtype:
+    """Return the Numpy structured dtype of a vertex described by header."""
+    order, types = header.form_str[0], header.form_str[1:]
+    return np.dtype([(n, order + t) for n, t in zip(header.names, types)])
+
+
+def _put(queue: Queue, item, stop: threading.Event) -> bool:
+    """Put item on the queue, waiting until there is room unless the stop
+    event is set first.  Returns whether the item was put."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def prefetch(items: Iterator, depth: int=2) -> Iterator:
+    """Yield from an iterator which is advanced in a background thread, up
+    to depth items ahead of the consumer.
+
+    Exceptions in the background thread are raised in the consumer.  This
+    overlaps reading with processing wherever the reader releases the GIL,
+    as file reads and most Numpy operations do.
+    """
+    queue = Queue(maxsize=depth)  # type: Queue
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(queue, (item, None), stop):
+                    return
+            _put(queue, (done, None), stop)
+        except BaseException as err:  # pylint:disable=broad-except
+            _put(queue, (done, err), stop)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = queue.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def pipeline(items: Iterator, compute: Callable,
+             write: Callable, depth: int=2) -> None:
+    """Call write(compute(item)) for each item, in three overlapping stages.
+
+    Items are read in a background thread as for :py:func:`prefetch`,
+    computed in the calling thread, and written in a second background
+    thread.  The stages are joined by queues of at most depth items, so a
+    slow stage holds back the others and memory use stays flat.  Results
+    are written in order, and an error in any stage is raised here once
+    the writer has finished.
+    """
+    results = Queue(maxsize=depth)  # type: Queue
+    stop = threading.Event()
+    done = object()
+    errors = []  # type: List[BaseException]
+
+    def consume():
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    return
+                write(result)
+        except BaseException as err:  # pylint:disable=broad-except
+            errors.append(err)
+            stop.set()
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        for item in prefetch(items, depth):
+            if not _put(results, compute(item), stop):
+                break
+    finally:
+        _put(results, done, stop)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _read_pix4d_ply_parts(fname_list: List[str], chunk_points: int,
+                          bbox: BBox=None,
+                          depth: int=2) -> Iterator[np.ndarray]:
+    """Yield chunks from a list of Pix4D ply files as if they were one file.
 
     Pix4D usually exports point clouds in parts, with an xyz offset for the
     origin.  This means that we can yield the points from each, correcting
@@ -95,17 +479,43 @@ def _read_pix4d_ply_parts(fname_list: List[str]) -> Iterator:
     of precision (to any significant degree).  However UTM XY coordinates
     can't be added; we don't know the UTM zone and loss of precision may
     be noticible if we did.
+
+    The offset for each part is added to whole chunks, which are read up to
+    depth chunks ahead in a background thread so that the next part is
+    being read while the current one is processed.
     """
     for f in fname_list:
         _check_input(f)
-    f = fname_list.pop(0)
-    ox, oy, oz = offset_for(f)
-    for p in _read_ply(f):
-        yield p._replace(z=p.z+oz)
+    yield from prefetch(_offset_parts(fname_list, chunk_points, bbox), depth)
+
+
+def _offset_parts(fname_list: List[str], chunk_points: int,
+                  bbox: BBox=None) -> Iterator[np.ndarray]:
+    """Yield chunks from each of the parts in turn, corrected for the offset
+    of each part from the first."""
+    ox, oy, _ = offset_for(fname_list[0])
     for f in fname_list:
         dx, dy, dz = [b - a for a, b in zip([ox, oy, 0], offset_for(f))]
-        for p in _read_ply(f):
-            yield p._replace(x=p.x+dx)._replace(y=p.y+dy)._replace(z=p.z+dz)
+        local = None
+        if bbox is not None:
+            # Pad by a meter so that rounding can't exclude any points
+            local = (bbox[0] - dx - 1, bbox[1] - dy - 1,
+                     bbox[2] - dx + 1, bbox[3] - dy + 1)
+        for chunk in _read_ply(f, chunk_points, local):
+            chunk = chunk.astype(_widen_xyz(chunk.dtype))
+            chunk['x'] += dx
+            chunk['y'] += dy
+            chunk['z'] += dz
+            if bbox is not None:
+                chunk = _in_bbox(chunk, bbox)
+            if chunk.size:
+                yield chunk
+
+
+def _widen_xyz(dtype: np.dtype) -> np.dtype:
+    """Return dtype with the x, y and z fields changed to float64."""
+    return np.dtype([(n, np.float64 if n in ('x', 'y', 'z') else dtype[n])
+                     for n in dtype.names])
 
 
 def ply_header_text(filename: str) -> bytes:
@@ -171,18 +581,87 @@ def parse_ply_header(header_text: bytes) -> PlyHeader:
     return PlyHeader(int(vertex_count), names, form_str, comments)
 
 
-def _read_ply(fname: str) -> Iterator:
-    """Opens the specified file, and returns a point set in the format required
-    by attributes_from_cloud.  Only handles xyzrgb point clouds, but that's
-    a fine subset of the format.  See http://paulbourke.net/dataformats/ply/"""
+def _read_ply(fname: str, chunk_points: int,
+              bbox: BBox=None) -> Iterator[np.ndarray]:
+    """Opens the specified file, and yields the vertices in chunks of up to
+    chunk_points.  Only handles xyzrgb point clouds, but that's
+    a fine subset of the format.  See http://paulbourke.net/dataformats/ply/
+
+    If bbox is given, only yields points inside it, using the sidecar index
+    to skip other records if possible."""
     header_bytes = ply_header_text(fname)
     header = parse_ply_header(header_bytes)
-    point = namedtuple('Point', header.names)  # type: ignore
-    fmt = struct.Struct(header.form_str)
+    dtype = vertex_dtype(header)
+    ranges = [(0, header.vertex_count)]
+    index = None if bbox is None else _load_index(fname)
+    if index is not None:
+        # Read through gaps of up to a megabyte
+        ranges = _index_ranges(index, bbox, 2**20 // dtype.itemsize)
     with open(fname, 'rb') as f:
-        f.seek(len(header_bytes))
-        for _ in range(header.vertex_count):
-            yield point._make(fmt.unpack(f.read(fmt.size)))  # type: ignore
+        for start, stop in ranges:
+            f.seek(len(header_bytes) + start * dtype.itemsize)
+            remaining = stop - start
+            while remaining:
+                chunk = np.fromfile(f, dtype=dtype,
+                                    count=min(chunk_points, remaining))
+                if not chunk.size:
+                    error = 'File "{}" ended before all {} vertices were '\
+                        'read.'.format(fname, header.vertex_count)
+                    logging.error(error)
+                    raise ValueError(error)
+                remaining -= chunk.size
+                if bbox is not None:
+                    chunk = _in_bbox(chunk, bbox)
+                    if not chunk.size:
+                        continue
+                yield chunk
+
+
+def _ply_head(header: PlyHeader, utm: UTM_Coord, count: int,
+              width: int=0) -> bytes:
+    """Return the header for a little-endian binary .ply file of count
+    vertices, with the count padded to width characters."""
+    to_ply_types = {v: k for k, v in PLY_TYPES.items()}
+    properties = ['property {t} {n}'.format(t=t, n=n) for t, n in zip(
+        (to_ply_types[p] for p in header.form_str[1:]), header.names)]
+    head = ['ply',
+            'format binary_little_endian 1.0',
+            'element vertex {:<{}}'.format(count, width),
+            '\n'.join(properties),
+            'end_header']
+    if utm is not None:
+        head.insert(-1, 'comment UTM x y zone north ' +
+                    '{0.x} {0.y} {0.zone} {0.north}'.format(utm))
+    return ('\n'.join(head) + '\n').encode('ascii')
+
+
+def _with_dtype(points: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Copy the fields of a structured array into a new array of dtype,
+    matching fields by name."""
+    out = np.empty(points.shape, dtype=dtype)
+    for name in dtype.names:
+        out[name] = points[name]
+    return out
+
+
+def morton_codes(points: np.ndarray, cellsize: float) -> np.ndarray:
+    """Return the Morton (Z-order) code of the grid cell of each point.
+
+    Cells are ``floor(coord / cellsize)``, as for the forestutils grid, and
+    codes interleave the bits of the x and y cell indices, offset to be
+    non-negative.  Sorting by code keeps nearby cells close together.
+    """
+    codes = np.zeros(points.shape, dtype=np.uint64)
+    for shift, axis in enumerate('xy'):
+        cell = np.floor(points[axis].astype(np.float64) / cellsize)
+        v = (cell.astype(np.int64) + 2**31).astype(np.uint64) & 0xFFFFFFFF
+        v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+        v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+        v = (v | (v << 2)) & 0x3333333333333333
+        v = (v | (v << 1)) & 0x5555555555555555
+        codes |= v << shift
+    return codes
 
 
 class IncrementalWriter:
@@ -193,11 +672,24 @@ class IncrementalWriter:
     streaming points to disk even when the header is unknown in advance.
     This allows some nice tricks, including splitting a point cloud into
     multiple files in a single pass, without memory issues.
+
+    Points can be added one at a time by calling the writer, or a chunk at
+    a time with :py:meth:`write_many`.  The file is written out by
+    :py:meth:`close`, or on leaving a ``with`` block - and only when the
+    writer is garbage collected if neither is used.  If the block raises,
+    nothing is written, so a failed run never leaves a truncated file.
+
+    If a cellsize is given, points are written in Morton order of their
+    grid cell.  Each run of up to run_points points is sorted as it is
+    completed, and the sorted runs are merged when the file is written, so
+    memory use is bounded however large the cloud.  The order of points
+    within a cell is not preserved.
     """
     # pylint:disable=too-few-public-methods
 
     def __init__(self, filename: str, header: PlyHeader,
-                 utm: UTM_Coord=None, buffer=2**22) -> None:
+                 utm: UTM_Coord=None, buffer=2**22, *,
+                 cellsize: float=None, run_points: int=2**21) -> None:
         """
         Args:
             filename: final place to save the file on disk.
@@ -207,6 +699,10 @@ class IncrementalWriter:
                 the temporary file to disk.  Default 1MB, which holds ~8300
                 points - enough for most objects but still practical to hold
                 thousands in memory.  Set a smaller buffer for large forests.
+            cellsize (float): if given, write points in Morton order of
+                the grid cells of this size.
+            run_points (int): the number of points to sort in memory at
+                once when writing in Morton order.
         """
         self.filename = filename
         self.temp_storage = SpooledTemporaryFile(max_size=buffer, mode='w+b')
@@ -216,6 +712,21 @@ class IncrementalWriter:
         self.header = header
         # Always write in little-endian mode; only store type information
         self.binary = struct.Struct('<' + header.form_str[1:])
+        self.dtype = vertex_dtype(header._replace(
+            form_str='<' + header.form_str[1:]))
+        self.cellsize = cellsize
+        self.run_points = run_points
+        self._runs = []  # type: List[Tuple[int, int]]
+        self.closed = False
+
+    def __enter__(self) -> 'IncrementalWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
 
     def __call__(self, point) -> None:
         """Add a single point to this pointcloud, saving in binary format.
@@ -225,37 +736,218 @@ class IncrementalWriter:
         """
         self.temp_storage.write(self.binary.pack(*point))
         self.count += 1
+        if self.cellsize is not None and \
+                self.count - self._run_start() >= self.run_points:
+            self._sort_run()
+
+    def write_many(self, points: np.ndarray) -> None:
+        """Add a structured array of points to this pointcloud in one write.
+
+        Args:
+            points: vertex attributes, with a field for each header name.
+        """
+        out = _with_dtype(points, self.dtype)
+        self.temp_storage.write(out.tobytes())
+        self.count += out.size
+        if self.cellsize is not None and \
+                self.count - self._run_start() >= self.run_points:
+            self._sort_run()
+
+    def _run_start(self) -> int:
+        """Index of the first point which is not yet in a sorted run."""
+        return self._runs[-1][1] if self._runs else 0
+
+    def _read_points(self, start: int, stop: int) -> np.ndarray:
+        """Read the points from start to stop from temporary storage."""
+        self.temp_storage.seek(start * self.dtype.itemsize)
+        data = self.temp_storage.read((stop - start) * self.dtype.itemsize)
+        return np.frombuffer(data, dtype=self.dtype)
+
+    def _sort_run(self) -> None:
+        """Sort the points added since the last run into Morton order."""
+        start = self._run_start()
+        if start == self.count:
+            return
+        run = self._read_points(start, self.count)
+        run = run[np.argsort(morton_codes(run, self.cellsize), kind='stable')]
+        self.temp_storage.seek(start * self.dtype.itemsize)
+        self.temp_storage.write(run.tobytes())
+        self._runs.append((start, self.count))
+
+    def _merge_runs(self, f) -> None:
+        """Write the merged sorted runs to f, a block from each at a time."""
+        block = max(1, self.run_points // len(self._runs))
+        position = [start for start, _ in self._runs]
+        buffers = [np.empty(0, dtype=self.dtype) for _ in self._runs]
+        codes = [np.empty(0, dtype=np.uint64) for _ in self._runs]
+        while True:
+            for i, (_, stop) in enumerate(self._runs):
+                if not buffers[i].size and position[i] < stop:
+                    end = min(position[i] + block, stop)
+                    buffers[i] = self._read_points(position[i], end)
+                    codes[i] = morton_codes(buffers[i], self.cellsize)
+                    position[i] = end
+            if not any(b.size for b in buffers):
+                return
+            # Anything up to the last buffered code of every partly-read run
+            # must come before all the points which have not been read yet
+            limits = [c[-1] for c, p, (_, stop) in
+                      zip(codes, position, self._runs) if c.size and p < stop]
+            limit = min(limits) if limits else np.iinfo(np.uint64).max
+            take = [np.searchsorted(c, limit, side='right') for c in codes]
+            out = np.concatenate([b[:t] for b, t in zip(buffers, take)])
+            out_codes = np.concatenate([c[:t] for c, t in zip(codes, take)])
+            f.write(out[np.argsort(out_codes, kind='stable')].tobytes())
+            buffers = [b[t:] for b, t in zip(buffers, take)]
+            codes = [c[t:] for c, t in zip(codes, take)]
 
     def __del__(self):
-        """Flush data to disk and clean up."""
-        logging.debug('Flushing data to disk in IncrementalWriter.__del__()')
-        to_ply_types = {v: k for k, v in PLY_TYPES.items()}
-        properties = ['property {t} {n}'.format(t=t, n=n) for t, n in zip(
-            (to_ply_types[p] for p in self.header.form_str[1:]),
-            self.header.names)]
-        head = ['ply',
-                'format binary_little_endian 1.0',
-                'element vertex {}'.format(self.count),
-                '\n'.join(properties),
-                'end_header']
-        if self.utm is not None:
-            head.insert(-1, 'comment UTM x y zone north ' +
-                        '{0.x} {0.y} {0.zone} {0.north}'.format(self.utm))
+        """Flush data to disk and clean up, if not already closed."""
+        if not getattr(self, 'closed', True):
+            logging.debug('Flushing data to disk in IncrementalWriter.__del__()')
+            self.close()
+
+    def discard(self) -> None:
+        """Clean up without writing the file, eg. after an error."""
+        if self.closed:
+            return
+        self.closed = True
+        self._runs = []
+        self.temp_storage.close()
+
+    def close(self) -> None:
+        """Write the file to disk and clean up.  Only the first call has
+        any effect."""
+        if self.closed:
+            return
+        self.closed = True
         if not os.path.isdir(os.path.dirname(self.filename)):
             os.makedirs(os.path.dirname(self.filename))
+        if self.cellsize is not None:
+            self._sort_run()
         with open(self.filename, 'wb') as f:
-            f.write(('\n'.join(head) + '\n').encode('ascii'))
-            self.temp_storage.seek(0)
-            chunk = self.temp_storage.read(8192)
-            while chunk:
-                f.write(chunk)
+            f.write(_ply_head(self.header, self.utm, self.count))
+            if len(self._runs) > 1:
+                self._merge_runs(f)
+            else:
+                self.temp_storage.seek(0)
                 chunk = self.temp_storage.read(8192)
+                while chunk:
+                    f.write(chunk)
+                    chunk = self.temp_storage.read(8192)
         self.temp_storage.close()
 
 
+class WriterPool:
+    """Write chunks of points to many .ply files at once.
+
+    Points are buffered in memory for each file, up to a total of memory
+    bytes for all files.  When that is exceeded, the least recently used
+    buffers are appended to their files until half the budget is free, and
+    at most max_open files are held open at once.  Each file starts with a
+    padded vertex count, which is filled in when the pool is closed - use
+    the pool as a context manager to make sure that happens.  If the block
+    raises, the counts are left at zero so no partial file looks complete.
+    """
+
+    def __init__(self, header: PlyHeader, utm: UTM_Coord=None,
+                 memory: int=2**26, max_open: int=256) -> None:
+        self.header = header
+        self.utm = utm
+        self.memory = memory
+        self.max_open = max_open
+        # Always write in little-endian mode, as for IncrementalWriter
+        self.dtype = vertex_dtype(header._replace(
+            form_str='<' + header.form_str[1:]))
+        self._head = _ply_head(header, utm, 0, width=20)
+        self._count_offset = self._head.index(b'element vertex ') + 15
+        self._buffers = OrderedDict()  # type: Dict[str, List[bytes]]
+        self._buffered = 0
+        self._handles = OrderedDict()  # type: Dict[str, object]
+        self._started = set()  # type: Set[str]
+        self.counts = {}  # type: Dict[str, int]
+
+    def __enter__(self) -> 'WriterPool':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, filename: str, points: np.ndarray) -> None:
+        """Append a structured array of points to the named file."""
+        out = _with_dtype(points, self.dtype)
+        data = out.tobytes()
+        self._buffers.setdefault(filename, []).append(data)
+        self._buffers.move_to_end(filename)
+        self._buffered += len(data)
+        self.counts[filename] = self.counts.get(filename, 0) + out.size
+        if self._buffered > self.memory:
+            self._evict(self.memory // 2)
+
+    def _evict(self, target: int) -> None:
+        """Flush least recently used buffers until at most target bytes are
+        buffered."""
+        while self._buffers and self._buffered > target:
+            filename, chunks = self._buffers.popitem(last=False)
+            self._handle(filename).write(b''.join(chunks))
+            self._buffered -= sum(len(c) for c in chunks)
+
+    def _handle(self, filename: str):
+        """Return an open file to append to, closing the least recently used
+        file if too many are open."""
+        if filename in self._handles:
+            self._handles.move_to_end(filename)
+            return self._handles[filename]
+        if filename in self._started:
+            f = open(filename, 'r+b')
+            f.seek(0, os.SEEK_END)
+        else:
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(filename, 'wb')
+            f.write(self._head)
+            self._started.add(filename)
+        self._handles[filename] = f
+        if len(self._handles) > self.max_open:
+            self._handles.popitem(last=False)[1].close()
+        return f
+
+    def discard(self) -> None:
+        """Close all files without writing buffered points or filling in
+        vertex counts, eg. after an error."""
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
+        self._buffers.clear()
+        self._buffered = 0
+        self._started.clear()
+
+    def close(self) -> None:
+        """Write out all buffered points and fill in the vertex count of
+        every file, in sorted order of file names."""
+        for filename in sorted(self._buffers):
+            self._handle(filename).write(b''.join(self._buffers[filename]))
+        self._buffers.clear()
+        self._buffered = 0
+        for filename in sorted(self._started):
+            f = self._handle(filename)
+            f.seek(self._count_offset)
+            f.write(str(self.counts[filename]).encode('ascii'))
+            self._handles.pop(filename).close()
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
+        self._started.clear()
+
+
 def write(cloud: Iterator, fname: str, header: PlyHeader,
-          utm: UTM_Coord) -> None:
-    """Write the given cloud to disk."""
-    writer = IncrementalWriter(fname, header, utm)
-    for p in cloud:
-        writer(p)
+          utm: UTM_Coord, cellsize: float=None) -> None:
+    """Write the given cloud to disk, in Morton order of grid cells if
+    cellsize is given."""
+    with IncrementalWriter(fname, header, utm, cellsize=cellsize) as writer:
+        for p in cloud:
+            writer(p)
@@ -0,0 +1,169 @@
+"""
+Lightweight instrumentation of a processing run.
+
+A :py:class:`Telemetry` instance times named stages, counts points (and any
+other quantities) as they are processed, and samples memory use and the
+bytes read and written by the process at the end of each stage.  The
+results can be written as a JSON report, and an optional progress line
+shows the throughput and estimated time remaining of the current stage.
+
+Memory and I/O figures come from the ``resource`` module and
+``/proc/self/io`` where available, and are zero elsewhere.  Bytes read and
+written count all read and write calls, whether or not they reached the
+disk, but not access through memory maps.
+"""
+
+from collections import Counter
+import contextlib
+import datetime
+import json
+import sys
+import time
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # type: ignore
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes, or 0 if unknown."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, MacOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident memory of this process to its current use,
+    where the OS allows (Linux); return whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def io_bytes() -> Tuple[int, int]:
+    """Return the (read, written) bytes of this process so far, or zeros if
+    unknown."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class Telemetry:
+    """
+    Collects timings, counters, memory and I/O for the stages of a run.
+    """
+
+    def __init__(self, progress: bool=False, stream=None,
+                 interval: float=0.5) -> None:
+        """
+        Args:
+            progress (bool): whether to show a live progress line.
+            stream: where to write the progress line; default stderr.
+            interval (float): minimum seconds between progress updates.
+        """
+        self.progress = progress
+        self.stream = stream
+        self.interval = interval
+        self.started = datetime.datetime.now()
+        self.counters = Counter()  # type: Counter
+        self.stages = []  # type: List[Dict]
+        self.info = {}  # type: Dict
+        self._stage = None  # type: str
+        self._stage_start = 0.
+        self._stage_points = 0
+        self._total = None  # type: int
+        self._last_update = 0.
+
+    @contextlib.contextmanager
+    def stage(self, name: str, total: int=None) -> Iterator[None]:
+        """Time a stage of the run.  Total is the number of points the stage
+        is expected to process, for the progress line."""
+        start, (read, written) = time.perf_counter(), io_bytes()
+        before = self.counters.copy()
+        self._stage, self._stage_start, self._total = name, start, total
+        self._stage_points = 0
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            now_read, now_written = io_bytes()
+            counts = self.counters - before
+            record = {
+                'stage': name,
+                'seconds': seconds,
+                'counters': dict(counts),
+                'points_per_second':
+                    counts['points'] / seconds if seconds else None,
+                'bytes_read': now_read - read,
+                'bytes_written': now_written - written,
+                'peak_rss': peak_rss(),
+            }
+            self.stages.append(record)
+            if self.progress and self._last_update:
+                self._write('\n')
+            self._stage, self._total, self._last_update = None, None, 0.
+
+    def count(self, name: str, number: int=1) -> None:
+        """Add number to the named counter."""
+        self.counters[name] += number
+
+    def track(self, chunks: Iterator) -> Iterator:
+        """Yield from an iterator of arrays of points, counting the points
+        and updating the progress line."""
+        for chunk in chunks:
+            yield chunk
+            self.counters['points'] += len(chunk)
+            self._stage_points += len(chunk)
+            if self.progress:
+                self._show_progress()
+
+    def _write(self, text: str) -> None:
+        stream = self.stream or sys.stderr
+        stream.write(text)
+        stream.flush()
+
+    def _show_progress(self) -> None:
+        """Show the current stage, throughput and ETA, at most once per
+        interval."""
+        now = time.perf_counter()
+        if now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        elapsed = now - self._stage_start
+        rate = self._stage_points / elapsed if elapsed else 0
+        line = '{}: {:,} points, {:,.0f} points/s'.format(
+            self._stage, self._stage_points, rate)
+        if self._total and rate:
+            done = min(self._stage_points / self._total, 1)
+            eta = max(self._total - self._stage_points, 0) / rate
+            line += ', {:.0%} done, ETA {:.0f}s'.format(done, eta)
+        self._write('\r' + line.ljust(79))
+
+    def report(self) -> Dict:
+        """Return the run report as a JSON-serialisable dict."""
+        read, written = io_bytes()
+        return {
+            'started': self.started.isoformat(),
+            'seconds': (datetime.datetime.now() - self.started).total_seconds(),
+            'info': self.info,
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'bytes_read': read,
+            'bytes_written': written,
+            'peak_rss': peak_rss(),
+        }
+
+    def write_report(self, fname: str) -> None:
+        """Write the run report to a JSON file."""
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
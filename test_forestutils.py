@@ -0,0 +1,154 @@
+"""
+Regression tests for the vectorised parts of forestutils, which must give
+exactly the same results as the straightforward per-point and per-cell
+code they replaced.
+"""
+# pylint:disable=protected-access
+
+import math
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+from . import forestutils, gridstore, pointcloudfile
+
+
+TEST_CLOUD = os.path.join(os.path.dirname(__file__),
+                          'test_data', 'test_point_cloud.ply')
+
+
+def _set_args(*extra: str) -> None:
+    """Set forestutils.args as if run from the command line."""
+    argv, sys.argv = sys.argv, ['forestutils', TEST_CLOUD] + list(extra)
+    try:
+        forestutils.args = forestutils.get_args()
+    finally:
+        sys.argv = argv
+
+
+def _copy_cloud(directory) -> str:
+    """Copy the test cloud and its offset to directory, so that indexes and
+    state files are not written into test_data."""
+    for name in os.listdir(os.path.dirname(TEST_CLOUD)):
+        shutil.copy(os.path.join(os.path.dirname(TEST_CLOUD), name),
+                    str(directory))
+    return os.path.join(str(directory), os.path.basename(TEST_CLOUD))
+
+
+def test_cell_summary_matches_per_point_loop():
+    _set_args()
+    rng = np.random.RandomState(0)
+    points = np.zeros(5000, dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    points['x'] = rng.uniform(-3, 3, points.size)
+    points['y'] = rng.uniform(-3, 3, points.size)
+    points['z'] = rng.normal(0, 2, points.size)
+    expected = {}
+    for p in points:
+        key = (math.floor(float(p['x']) / forestutils.args.cellsize),
+               math.floor(float(p['y']) / forestutils.args.cellsize))
+        count, low, high = expected.get(key, (0, p['z'], p['z']))
+        expected[key] = (count + 1, min(low, p['z']), max(high, p['z']))
+    x, y, count, low, high = forestutils.cell_summary(
+        *forestutils.cell_indices(points), points['z'])
+    assert list(zip(x.tolist(), y.tolist())) == sorted(expected)
+    assert [expected[k] for k in sorted(expected)] == list(zip(
+        count.tolist(), low.tolist(), high.tolist()))
+
+
+def test_update_spatial_matches_per_point_loop():
+    _set_args()
+    density, canopy = {}, {}
+    for p in pointcloudfile.read(TEST_CLOUD):
+        key = forestutils.coords(p)
+        density[key] = density.get(key, 0) + 1
+        canopy[key] = max(canopy.get(key, p.z), p.z)
+    attr_map = forestutils.MapObj(TEST_CLOUD, colours=False)
+    assert dict(attr_map.density) == density
+    assert dict(attr_map.canopy) == canopy
+
+
+def _reference_smooth(ground: dict) -> None:
+    """The per-cell smooth_ground which forestutils.smooth_ground replaced."""
+    step = 2 * forestutils.args.cellsize
+    problematic = set(ground)
+    for _ in range(forestutils.SMOOTHING_PASSES):
+        found = set()
+        for k in problematic:
+            adjacent = {ground.get(n) for n in forestutils.neighbors(k)}
+            adjacent.discard(None)
+            if len(adjacent) < 6:
+                continue
+            if sum(abs(ground[k] - n) > step for n in adjacent) >= 3:
+                found.add(k)
+        problematic = found
+        for key in problematic:
+            adjacent = {ground.get(n) for n in forestutils.neighbors(key)
+                        if n not in problematic}
+            adjacent.discard(None)
+            if adjacent:
+                ground[key] = min(adjacent) + step
+
+
+def test_smooth_ground_matches_per_cell_reference():
+    _set_args()
+    rng = np.random.RandomState(0)
+    x, y = np.meshgrid(np.arange(-20, 30), np.arange(-15, 35), indexing='ij')
+    keep = rng.uniform(size=x.shape) < 0.9
+    x, y = x[keep], y[keep]
+    # A gentle slope with noise, and spikes above and below the ground
+    z = 0.01 * x + rng.normal(0, 0.05, x.size)
+    spikes = rng.uniform(size=x.size) < 0.1
+    z[spikes] += rng.choice([-2.0, 2.0], spikes.sum())
+    # Small tiles, so that smoothing crosses many tile edges
+    ground = gridstore.Channel(np.float64, tile_size=8)
+    ground.set_many(x, y, z)
+    expected = dict(zip(map(gridstore.XY_Coord, x.tolist(), y.tolist()),
+                        z.tolist()))
+    _reference_smooth(expected)
+    forestutils.smooth_ground(ground)
+    assert dict(ground) == expected
+
+
+def test_tiled_mapping_matches_whole_site(tmpdir):
+    fname = _copy_cloud(tmpdir)
+    # Tiles much smaller than the halo, so most cells are in several tiles
+    _set_args('--tilesize', '5')
+    serial = forestutils.MapObj(fname, colours=False)
+    tiled = forestutils.MapObj(fname, colours=False, processes=2)
+    for name in ('density', 'filtered_density', 'ground', 'canopy', 'trees'):
+        assert dict(tiled.grid[name]) == dict(serial.grid[name]), name
+    assert len(set(dict(serial.trees).values())) > 1
+
+
+def _saved_state(tmpdir):
+    """Map a copy of the test cloud and save its state; return the names
+    of the copy and the state file, and the map."""
+    fname = _copy_cloud(tmpdir)
+    state = os.path.join(str(tmpdir), 'state.npz')
+    _set_args()
+    attr_map = forestutils.MapObj(fname, colours=False)
+    attr_map.save_state(state)
+    return fname, state, attr_map
+
+
+def test_state_reload_matches_fresh_map(tmpdir):
+    fname, state, fresh = _saved_state(tmpdir)
+    loaded = forestutils.MapObj(fname, colours=False, state=state)
+    assert loaded.state_loaded
+    for name in fresh.grid.channels:
+        assert dict(loaded.grid[name]) == dict(fresh.grid[name]), name
+
+
+@pytest.mark.parametrize('change', ['cellsize', 'grounddepth', 'fingerprint'])
+def test_state_rejected_when_out_of_date(tmpdir, change):
+    fname, state, _ = _saved_state(tmpdir)
+    if change == 'fingerprint':
+        mtime = os.stat(fname).st_mtime + 10
+        os.utime(fname, (mtime, mtime))
+    else:
+        _set_args('--' + change, '0.3')
+    assert not forestutils.MapObj(
+        fname, colours=False, state=state).state_loaded
@@ -0,0 +1,64 @@
+"""
+Tests for appending to GeoPly files with GeoPlyWriter, checked by reading
+them back with GeoPly.read.
+"""
+
+import os
+
+import numpy as np
+
+from . import geoply
+
+
+BASE = geoply.UTM_COORD(500000.0, 6000000.0, 55, False)
+DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('red', 'u1')])
+
+
+def _vertices(size: int, seed: int) -> np.ndarray:
+    """Return a structured array of random vertices."""
+    rng = np.random.RandomState(seed)
+    vertices = np.zeros(size, dtype=DTYPE)
+    for name in 'xyz':
+        vertices[name] = rng.uniform(-50, 50, size)
+    vertices['red'] = rng.randint(0, 256, size)
+    return vertices
+
+
+def _write_unpadded(fname: str, vertices: np.ndarray) -> None:
+    """Write a GeoPly file with its exact vertex count in the header."""
+    geoply.GeoPly(vertices, utm_coord=BASE).write(fname)
+    with open(fname, 'rb') as f:
+        head = f.read(512)
+    assert '\nelement vertex {}\n'.format(vertices.size).encode() in head
+
+
+def test_append_to_unpadded_count(tmpdir):
+    fname = os.path.join(str(tmpdir), 'cloud.ply')
+    first, second = _vertices(100, 0), _vertices(37, 1)
+    _write_unpadded(fname, first)
+    with geoply.GeoPlyWriter(fname, DTYPE, BASE, append=True) as writer:
+        writer.write(second)
+    cloud = geoply.GeoPly.read(fname)
+    assert cloud.utm_coord == BASE
+    assert np.array_equal(cloud['vertex'].data,
+                          np.concatenate([first, second]))
+
+
+def test_append_with_other_utm_coord(tmpdir):
+    fname = os.path.join(str(tmpdir), 'cloud.ply')
+    first, second = _vertices(100, 0), _vertices(37, 1)
+    _write_unpadded(fname, first)
+    shifted = BASE._replace(easting=BASE.easting + 10,
+                            northing=BASE.northing - 5)
+    with geoply.GeoPlyWriter(fname, DTYPE, shifted, append=True) as writer:
+        writer.write(second)
+    # Append again, to the count padded by the first append
+    with geoply.GeoPlyWriter(fname, DTYPE, BASE, append=True) as writer:
+        writer.write(first)
+    cloud = geoply.GeoPly.read(fname)
+    expected = second.copy()
+    expected['x'] += 10
+    expected['y'] -= 5
+    assert cloud.utm_coord == BASE
+    assert np.array_equal(cloud['vertex'].data,
+                          np.concatenate([first, expected, first]))
@@ -0,0 +1,104 @@
+"""
+Tests for the point cloud writers in pointcloudfile, checked by reading
+their output back.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from . import pointcloudfile
+
+
+HEADER = pointcloudfile.PlyHeader(0, ('x', 'y', 'z', 'red'), '<fffB', ())
+
+
+def _random_points(size: int, seed: int=0) -> np.ndarray:
+    """Return a structured array of random points for HEADER."""
+    rng = np.random.RandomState(seed)
+    points = np.zeros(size, dtype=pointcloudfile.vertex_dtype(HEADER))
+    for name in 'xyz':
+        points[name] = rng.uniform(-10, 10, size)
+    points['red'] = rng.randint(0, 256, size)
+    return points
+
+
+def _read_back(fname: str) -> np.ndarray:
+    """Return every point in a .ply file as one structured array."""
+    chunks = list(pointcloudfile.read_chunks(fname))
+    return np.concatenate(chunks) if chunks else np.empty(
+        0, dtype=pointcloudfile.vertex_dtype(HEADER))
+
+
+def test_morton_order_over_many_runs(tmpdir):
+    fname = os.path.join(str(tmpdir), 'sorted.ply')
+    points = _random_points(1000)
+    with pointcloudfile.IncrementalWriter(
+            fname, HEADER, cellsize=0.5, run_points=64) as writer:
+        # Mix single points and chunks, so runs end part way through both
+        for p in points[:100]:
+            writer(p.tolist())
+        for start in range(100, 900, 70):
+            writer.write_many(points[start:min(start + 70, 900)])
+        for p in points[900:]:
+            writer(p.tolist())
+    out = _read_back(fname)
+    assert pointcloudfile.parse_ply_header(
+        pointcloudfile.ply_header_text(fname)).vertex_count == points.size
+    assert np.array_equal(np.sort(out), np.sort(points))
+    codes = pointcloudfile.morton_codes(out, 0.5)
+    assert (codes[1:] >= codes[:-1]).all()
+
+
+def _write_pool(directory: str, **limits) -> dict:
+    """Write random chunks to a few files through a WriterPool, and return
+    the points written to each file."""
+    points = _random_points(2000, seed=1)
+    rng = np.random.RandomState(2)
+    names = [os.path.join(directory, 'tree_{}.ply'.format(i))
+             for i in range(6)]
+    expected = {name: [] for name in names}
+    with pointcloudfile.WriterPool(HEADER, **limits) as pool:
+        for start in range(0, points.size, 50):
+            name = names[rng.randint(len(names))]
+            pool.write(name, points[start:start + 50])
+            expected[name].append(points[start:start + 50])
+    return {name: np.concatenate(chunks) for name, chunks
+            in expected.items() if chunks}
+
+
+def test_writer_pool_eviction_gives_same_files(tmpdir):
+    for limits in [{}, {'memory': 2000, 'max_open': 2}]:
+        directory = tmpdir.mkdir(str(len(limits)))
+        expected = _write_pool(str(directory), **limits)
+        assert len(expected) > 2
+        for name, points in expected.items():
+            assert np.array_equal(_read_back(name), points)
+    for name in os.listdir(str(tmpdir.join('0'))):
+        with open(str(tmpdir.join('0', name)), 'rb') as a, \
+                open(str(tmpdir.join('2', name)), 'rb') as b:
+            assert a.read() == b.read()
+
+
+def test_writer_pool_not_finalised_on_error(tmpdir):
+    points = _random_points(500)
+    fname = os.path.join(str(tmpdir), 'tree_0.ply')
+    with pytest.raises(RuntimeError):
+        with pointcloudfile.WriterPool(HEADER, memory=1000) as pool:
+            pool.write(fname, points)
+            raise RuntimeError
+    # The points were flushed over the memory limit, but not counted
+    assert os.path.isfile(fname)
+    assert pointcloudfile.parse_ply_header(
+        pointcloudfile.ply_header_text(fname)).vertex_count == 0
+
+
+def test_incremental_writer_discards_on_error(tmpdir):
+    fname = os.path.join(str(tmpdir), 'sparse.ply')
+    with pytest.raises(KeyboardInterrupt):
+        with pointcloudfile.IncrementalWriter(fname, HEADER) as writer:
+            writer.write_many(_random_points(10))
+            raise KeyboardInterrupt
+    assert writer.closed
+    assert not os.path.exists(fname)